@@ -1,14 +1,153 @@
+import csv
+import io
+import cProfile
+import contextvars
+import importlib
+import json
+import math
 import os
-from datetime import datetime, timedelta
-from flask import Flask, render_template, request, redirect, url_for, flash
+import re
+import sqlite3
+import tempfile
+import threading
+import time
+import tracemalloc
+import zlib
+from collections import OrderedDict, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+from datetime import date, datetime, timedelta
+from functools import lru_cache, wraps
+import click
+from flask import Flask, render_template, request, redirect, url_for, flash, g, has_app_context, \
+    has_request_context, Response, stream_with_context, send_file, abort, jsonify, \
+    before_render_template, template_rendered
 from flask_sqlalchemy import SQLAlchemy
+from flask_sqlalchemy.session import Session
+from sqlalchemy import event, Date
+from sqlalchemy.engine import Engine, make_url
+from sqlalchemy.exc import OperationalError
+from sqlalchemy.ext.compiler import compiles
+from sqlalchemy.sql.functions import FunctionElement
+from reportlab.lib.pagesizes import A4
+from reportlab.lib.units import mm
+from reportlab.pdfbase import pdfmetrics
+from reportlab.pdfbase.ttfonts import TTFont
+from reportlab.pdfgen import canvas
 
 app = Flask(__name__)
 app.config['SECRET_KEY'] = 'cosmetic-shop-secret-key-2024'
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///inventory.db'
+app.config['SQLALCHEMY_DATABASE_URI'] = os.environ.get('DATABASE_URL', 'sqlite:///inventory.db')
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
 
-db = SQLAlchemy(app)
+# ==================== DATABASE TUNING ====================
+
+def queue_pool_options(url):
+    # In-memory SQLite gets a StaticPool (one shared connection), which takes none of the QueuePool settings
+    url = make_url(url)
+    if url.get_backend_name() == 'sqlite' and (url.database in (None, '', ':memory:')
+                                               or url.query.get('mode') == 'memory'):
+        return {}
+    return {
+        'pool_size': int(os.environ.get('DB_POOL_SIZE', 10)),
+        'max_overflow': int(os.environ.get('DB_MAX_OVERFLOW', 20)),
+        'pool_timeout': int(os.environ.get('DB_POOL_TIMEOUT', 30))
+    }
+
+# PRAGMAs applied to every new SQLite connection; 'default' leaves SQLite's own settings alone
+SQLITE_PROFILES = {
+    'production': {
+        'journal_mode': 'WAL',
+        'synchronous': 'NORMAL',
+        'busy_timeout': 5000,
+        'mmap_size': 268435456,
+        'cache_size': -65536,
+        'temp_store': 'MEMORY'
+    },
+    'default': {}
+}
+
+app.config['DB_PROFILE'] = os.environ.get('DB_PROFILE', 'production')
+app.config['SQLITE_PRAGMAS'] = dict(SQLITE_PROFILES[app.config['DB_PROFILE']])
+for pragma in ('journal_mode', 'synchronous', 'busy_timeout', 'mmap_size', 'cache_size', 'temp_store'):
+    if os.environ.get(f'SQLITE_{pragma.upper()}'):
+        app.config['SQLITE_PRAGMAS'][pragma] = os.environ[f'SQLITE_{pragma.upper()}']
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    **queue_pool_options(app.config['SQLALCHEMY_DATABASE_URI']),
+    'pool_recycle': int(os.environ.get('DB_POOL_RECYCLE', 3600)),
+    'pool_pre_ping': True
+}
+# Optional read-only engine for report routes; any second SQLite file works as a stand-in replica
+if os.environ.get('READ_DATABASE_URL'):
+    app.config['SQLALCHEMY_BINDS'] = {'replica': {
+        'url': os.environ['READ_DATABASE_URL'],
+        **queue_pool_options(os.environ['READ_DATABASE_URL']),
+        'pool_recycle': app.config['SQLALCHEMY_ENGINE_OPTIONS']['pool_recycle'],
+        'pool_pre_ping': True
+    }}
+
+app.config['CACHE_ENABLED'] = os.environ.get('CACHE_ENABLED', '1') == '1'
+app.config['CACHE_TTL'] = int(os.environ.get('CACHE_TTL', 300))
+app.config['CACHE_MAX_ENTRIES'] = int(os.environ.get('CACHE_MAX_ENTRIES', 512))
+# Any object with get(key) and set(key, value, ttl), set here after import or named by CACHE_BACKEND=module:factory
+# (called once, on first use); defaults to the in-process LRUCache below
+app.config['CACHE_BACKEND'] = os.environ.get('CACHE_BACKEND') or None
+
+# Per-request query/render/memory instrumentation, Server-Timing headers and /metrics; off by default
+app.config['PROFILING_ENABLED'] = os.environ.get('PROFILING', '0') == '1'
+app.config['PROFILING_TRACE_MEMORY'] = os.environ.get('PROFILING_TRACE_MEMORY', '1') == '1'
+app.config['PROFILING_SLOW_QUERIES'] = int(os.environ.get('PROFILING_SLOW_QUERIES', 5))
+app.config['PROFILING_QUERY_WARNING'] = int(os.environ.get('PROFILING_QUERY_WARNING', 50))
+# ?profile=1 on any route writes a cProfile dump here (only while profiling is enabled)
+app.config['PROFILE_DIR'] = os.environ.get('PROFILE_DIR', os.path.join(app.instance_path, 'profiles'))
+
+# Background jobs run in a daemon thread when BACKGROUND_JOBS=1, or in a separate `flask run-jobs` process
+app.config['BACKGROUND_JOBS'] = os.environ.get('BACKGROUND_JOBS', '0') == '1'
+app.config['JOB_POLL_SECONDS'] = int(os.environ.get('JOB_POLL_SECONDS', 30))
+app.config['STOCK_ALERT_INTERVAL'] = int(os.environ.get('STOCK_ALERT_INTERVAL', 300))
+app.config['CUSTOMER_SEGMENT_INTERVAL'] = int(os.environ.get('CUSTOMER_SEGMENT_INTERVAL', 3600))
+
+# Heavy report routes run their DB work in a pool of this many threads per process (0 = in the request thread);
+# requests beyond the pool and REPORT_QUEUE waiting ones get a 503 instead of taking threads from the tills
+app.config['REPORT_WORKERS'] = int(os.environ.get('REPORT_WORKERS', 2))
+app.config['REPORT_QUEUE'] = int(os.environ.get('REPORT_QUEUE', 4))
+
+# Closed months of Sale/Expense older than ARCHIVE_KEEP_MONTHS move to per-year SQLite files with `flask archive-sales`
+app.config['ARCHIVE_DIR'] = os.environ.get('ARCHIVE_DIR', os.path.join(app.instance_path, 'archive'))
+app.config['ARCHIVE_KEEP_MONTHS'] = int(os.environ.get('ARCHIVE_KEEP_MONTHS', 12))
+
+# 'fifo' or 'average': how the cost of goods (and so Sale.profit) is taken from the stock ledger
+app.config['COSTING_METHOD'] = os.environ.get('COSTING_METHOD', 'fifo')
+app.config['EXPIRY_WARNING_DAYS'] = int(os.environ.get('EXPIRY_WARNING_DAYS', 30))
+app.config['REORDER_VELOCITY_DAYS'] = int(os.environ.get('REORDER_VELOCITY_DAYS', 28))
+app.config['REORDER_COVER_DAYS'] = int(os.environ.get('REORDER_COVER_DAYS', 14))
+app.config['DEFAULT_LEAD_TIME_DAYS'] = int(os.environ.get('DEFAULT_LEAD_TIME_DAYS', 7))
+
+@event.listens_for(Engine, 'connect')
+def apply_sqlite_pragmas(dbapi_connection, connection_record):
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    for pragma, value in app.config['SQLITE_PRAGMAS'].items():
+        cursor.execute(f'PRAGMA {pragma} = {value}')
+    cursor.close()
+
+class RoutingSession(Session):
+    # Reads made inside @read_only routes go to the 'replica' bind when one is configured
+    def get_bind(self, mapper=None, clause=None, bind=None, **kwargs):
+        if bind is None and not self._flushing and has_app_context() and g.get('read_only') \
+                and 'replica' in self._db.engines:
+            return self._db.engines['replica']
+        return super().get_bind(mapper=mapper, clause=clause, bind=bind, **kwargs)
+
+def read_only(view):
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        g.read_only = True
+        return view(*args, **kwargs)
+    return wrapper
+
+db = SQLAlchemy(app, session_options={'class_': RoutingSession})
 
 # ==================== DATABASE MODELS ====================
 
@@ -21,11 +160,18 @@ class Product(db.Model):
     selling_price = db.Column(db.Float, default=0)
     quantity = db.Column(db.Integer, default=0)
     reorder_level = db.Column(db.Integer, default=10)
-    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'))
+    supplier_id = db.Column(db.Integer, db.ForeignKey('supplier.id'), index=True)
     expiry_date = db.Column(db.Date, nullable=True)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Running valuation, maintained by receive_stock() / consume_stock(): cost of the open FIFO lots and the
+    # weighted-average unit cost
+    fifo_value = db.Column(db.Float, default=0)
+    average_cost = db.Column(db.Float)
     supplier = db.relationship('Supplier', backref='products')
     sales = db.relationship('Sale', backref='product', lazy=True)
+    __table_args__ = (db.Index('ix_product_quantity_reorder_level', 'quantity', 'reorder_level'),
+                      db.Index('ix_product_name_brand', 'name', 'brand'))
 
 class Supplier(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -37,7 +183,7 @@ class Supplier(db.Model):
     delivery_time = db.Column(db.String(50))
     credit_terms = db.Column(db.String(50))
     last_price_list = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
 
 class Customer(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -48,13 +194,22 @@ class Customer(db.Model):
     skin_type = db.Column(db.String(100))
     hair_type = db.Column(db.String(100))
     notes = db.Column(db.Text)
-    created_at = db.Column(db.DateTime, default=datetime.utcnow)
+    created_at = db.Column(db.DateTime, default=datetime.utcnow, index=True)
+    updated_at = db.Column(db.DateTime, default=datetime.utcnow, onupdate=datetime.utcnow, index=True)
+    # Purchase aggregates, maintained by add_to_customer_stats() and rebuilt by `flask rebuild-customer-stats`
+    lifetime_spend = db.Column(db.Float, default=0, index=True)
+    visit_count = db.Column(db.Integer, default=0, index=True)
+    last_purchase_at = db.Column(db.DateTime, index=True)
+    top_categories = db.Column(db.String(200))
+    rfm_score = db.Column(db.Integer)
+    rfm_segment = db.Column(db.String(20))
     purchases = db.relationship('Sale', backref='customer', lazy=True)
+    __table_args__ = (db.Index('ix_customer_rfm_segment_lifetime_spend', 'rfm_segment', 'lifetime_spend'),)
 
 class Sale(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False)
-    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=True, index=True)
     quantity = db.Column(db.Integer, nullable=False)
     unit_price = db.Column(db.Float, nullable=False)
     total_amount = db.Column(db.Float, nullable=False)
@@ -62,45 +217,1369 @@ class Sale(db.Model):
     receipt_number = db.Column(db.String(50), unique=True)
     sale_date = db.Column(db.DateTime, default=datetime.utcnow)
     profit = db.Column(db.Float, default=0)
+    __table_args__ = (db.Index('ix_sale_sale_date_id', 'sale_date', 'id'),)
+
+class ReceiptCounter(db.Model):
+    # Single-row sequence; incremented inside the sale transaction so receipt numbers never collide
+    id = db.Column(db.Integer, primary_key=True)
+    value = db.Column(db.Integer, nullable=False, default=0)
+
+class CacheVersion(db.Model):
+    # Bumped in the same transaction as each write, so every worker sees invalidations
+    name = db.Column(db.String(20), primary_key=True)
+    version = db.Column(db.Integer, nullable=False, default=0)
+
+class DailySalesSummary(db.Model):
+    # Rollup of Sale rows, maintained by record_sale() and rebuilt by `flask rebuild-daily-summary`
+    id = db.Column(db.Integer, primary_key=True)
+    day = db.Column(db.Date, nullable=False)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    category = db.Column(db.String(50), nullable=False, default='')
+    payment_method = db.Column(db.String(20), nullable=False, default='')
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    profit = db.Column(db.Float, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('day', 'product_id', 'category', 'payment_method',
+                                          name='uq_daily_sales_summary_key'),)
+
+class ArchivedMonth(db.Model):
+    # A closed month moved out of Sale/Expense into its year's archive file. Its DailySalesSummary rows stay,
+    # so reports keep their breakdowns; the totals here cover the rest
+    month = db.Column(db.Date, primary_key=True)
+    filename = db.Column(db.String(100), nullable=False)
+    archived_at = db.Column(db.DateTime, default=datetime.utcnow)
+    sale_count = db.Column(db.Integer, nullable=False, default=0)
+    revenue = db.Column(db.Float, nullable=False, default=0)
+    profit = db.Column(db.Float, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    expense_count = db.Column(db.Integer, nullable=False, default=0)
+    expense_total = db.Column(db.Float, nullable=False, default=0)
+
+class StockAlert(db.Model):
+    # Materialized low-stock, near-expiry and reorder lists, rewritten by refresh_stock_alerts() and kept
+    # current per product by update_stock_alerts()
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    # Sort key within the list, most urgent first: stock above the reorder level, expiry day, days of stock left
+    rank = db.Column(db.Float, nullable=False)
+    product_id = db.Column(db.Integer, nullable=False, index=True)
+    name = db.Column(db.String(200))
+    category = db.Column(db.String(50))
+    quantity = db.Column(db.Integer)
+    reorder_level = db.Column(db.Integer)
+    expiry_date = db.Column(db.Date)
+    daily_sales = db.Column(db.Float)
+    lead_time_days = db.Column(db.Integer)
+    suggested_quantity = db.Column(db.Integer)
+    __table_args__ = (db.Index('ix_stock_alert_kind_rank', 'kind', 'rank'),)
+
+class JobRun(db.Model):
+    # One row per background job; claimed with a conditional UPDATE so only one process runs it per interval
+    name = db.Column(db.String(50), primary_key=True)
+    last_started_at = db.Column(db.DateTime)
+    last_finished_at = db.Column(db.DateTime)
+    last_duration = db.Column(db.Float)
+    last_error = db.Column(db.Text)
+
+class DeletedRecord(db.Model):
+    # Tombstones for delta sync: ids of deleted products and customers, reported by the JSON API
+    id = db.Column(db.Integer, primary_key=True)
+    kind = db.Column(db.String(20), nullable=False)
+    record_id = db.Column(db.Integer, nullable=False)
+    deleted_at = db.Column(db.DateTime, nullable=False, default=datetime.utcnow)
+    __table_args__ = (db.Index('ix_deleted_record_kind_deleted_at', 'kind', 'deleted_at'),)
+
+class CustomerCategorySpend(db.Model):
+    # Per-customer totals by category; the source of Customer.top_categories
+    id = db.Column(db.Integer, primary_key=True)
+    customer_id = db.Column(db.Integer, db.ForeignKey('customer.id'), nullable=False)
+    category = db.Column(db.String(50), nullable=False, default='')
+    amount = db.Column(db.Float, nullable=False, default=0)
+    quantity = db.Column(db.Integer, nullable=False, default=0)
+    __table_args__ = (db.UniqueConstraint('customer_id', 'category', name='uq_customer_category_spend_key'),)
+
+class StockLot(db.Model):
+    # One row per receipt of stock; consumed oldest first
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    received_at = db.Column(db.DateTime, default=datetime.utcnow)
+    quantity_received = db.Column(db.Integer, nullable=False)
+    quantity_remaining = db.Column(db.Integer, nullable=False)
+    unit_cost = db.Column(db.Float, nullable=False, default=0)
+    # Only open lots are indexed, so FIFO lookups never walk fully consumed history
+    __table_args__ = (db.Index('ix_stock_lot_open', 'product_id', 'id',
+                               sqlite_where=db.text('quantity_remaining > 0'),
+                               postgresql_where=db.text('quantity_remaining > 0')),)
+
+class StockMovement(db.Model):
+    # Append-only ledger of every stock change; quantity and total_cost are negative for stock going out
+    id = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id'), nullable=False, index=True)
+    moved_at = db.Column(db.DateTime, default=datetime.utcnow)
+    kind = db.Column(db.String(20), nullable=False)
+    quantity = db.Column(db.Integer, nullable=False)
+    unit_cost = db.Column(db.Float)
+    total_cost = db.Column(db.Float)
+    reference = db.Column(db.String(50))
 
 class Expense(db.Model):
     id = db.Column(db.Integer, primary_key=True)
-    date = db.Column(db.Date, nullable=False)
+    date = db.Column(db.Date, nullable=False, index=True)
     category = db.Column(db.String(50))
     description = db.Column(db.Text)
     amount = db.Column(db.Float, nullable=False)
     created_at = db.Column(db.DateTime, default=datetime.utcnow)
 
+# ==================== PORTABLE SQL ====================
+
+class day_bucket(FunctionElement):
+    # Truncates a DateTime column to its calendar day on any backend
+    type = Date()
+    inherit_cache = True
+
+@compiles(day_bucket)
+def compile_day_bucket(element, compiler, **kw):
+    return f'CAST({compiler.process(element.clauses, **kw)} AS DATE)'
+
+@compiles(day_bucket, 'sqlite')
+def compile_day_bucket_sqlite(element, compiler, **kw):
+    return f'date({compiler.process(element.clauses, **kw)})'
+
 # ==================== DATABASE INITIALIZATION ====================
-with app.app_context():
-    db.create_all()
+
+def add_missing_columns():
+    # create_all() never alters existing tables; new nullable columns are added in place
+    inspector = db.inspect(db.engine)
+    with db.engine.begin() as conn:
+        for table in db.metadata.sorted_tables:
+            existing = {column['name'] for column in inspector.get_columns(table.name)}
+            for column in table.columns:
+                if column.name not in existing and column.nullable:
+                    column_type = column.type.compile(dialect=db.engine.dialect)
+                    conn.exec_driver_sql(f'ALTER TABLE {table.name} ADD COLUMN {column.name} {column_type}')
+
+# Setup that must run against every fresh database: at import time, and again after reset_database()
+STARTUP_TASKS = []
+
+def on_startup(task):
+    STARTUP_TASKS.append(task)
+    with app.app_context():
+        task()
+    return task
+
+def reset_database():
+    # Drops every table, including the raw-SQL search index, then replays the startup tasks
+    db.drop_all(bind_key=None)
+    db.session.execute(db.text('DROP TABLE IF EXISTS search_index'))
+    db.session.commit()
+    for task in STARTUP_TASKS:
+        task()
+
+def upgrade_schema():
+    # Brings an existing database up to the declared schema; safe to run repeatedly
+    db.create_all(bind_key=None)
+    add_missing_columns()
+    # create_all() skips indexes on tables that already exist
+    for table in db.metadata.sorted_tables:
+        for index in table.indexes:
+            index.create(db.engine, checkfirst=True)
+    if db.engine.dialect.name == 'sqlite':
+        with db.engine.connect() as conn:
+            conn.exec_driver_sql('PRAGMA optimize')
+
+@app.cli.command('upgrade-db')
+def upgrade_db_command():
+    """Create missing tables and indexes on an existing database."""
+    upgrade_schema()
+    print('Database schema is up to date.')
+
+@on_startup
+def prepare_schema():
+    upgrade_schema()
+    if db.session.get(ReceiptCounter, 1) is None:
+        db.session.add(ReceiptCounter(id=1, value=0))
+        db.session.commit()
+
+# ==================== INSTRUMENTATION ====================
+
+REQUEST_DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class RequestMetrics:
+    # Per-process totals; with several gunicorn workers, each worker serves its own /metrics
+    def __init__(self, slow_statements=20):
+        self.lock = threading.Lock()
+        self.routes = defaultdict(lambda: {'count': 0, 'duration': 0.0, 'queries': 0, 'sql': 0.0, 'render': 0.0,
+                                           'buckets': [0] * len(REQUEST_DURATION_BUCKETS)})
+        self.statements = {}
+        self.slow_statements = slow_statements
+        self.peak_memory = 0
+
+    def record(self, endpoint, duration, queries, sql_time, render_time, slowest, peak_memory):
+        with self.lock:
+            route = self.routes[endpoint]
+            route['count'] += 1
+            route['duration'] += duration
+            route['queries'] += queries
+            route['sql'] += sql_time
+            route['render'] += render_time
+            for i, bound in enumerate(REQUEST_DURATION_BUCKETS):
+                if duration <= bound:
+                    route['buckets'][i] += 1
+            for elapsed, statement in slowest:
+                if elapsed > self.statements.get(statement, 0):
+                    self.statements[statement] = elapsed
+            if len(self.statements) > self.slow_statements:
+                keep = sorted(self.statements.items(), key=lambda item: item[1], reverse=True)
+                self.statements = dict(keep[:self.slow_statements])
+            self.peak_memory = max(self.peak_memory, peak_memory)
+
+    def prometheus(self):
+        lines = []
+
+        def metric(name, kind, help_text, samples):
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            lines.extend(f'{name}{labels} {value}' for labels, value in samples)
+
+        with self.lock:
+            routes = sorted(self.routes.items())
+            buckets = []
+            for endpoint, route in routes:
+                for bound, count in zip(REQUEST_DURATION_BUCKETS, route['buckets']):
+                    buckets.append((f'{{endpoint="{endpoint}",le="{bound}"}}', count))
+                buckets.append((f'{{endpoint="{endpoint}",le="+Inf"}}', route['count']))
+            metric('shop_request_duration_seconds', 'histogram', 'Time spent handling requests.',
+                   buckets + [(f'_sum{{endpoint="{e}"}}', r['duration']) for e, r in routes]
+                   + [(f'_count{{endpoint="{e}"}}', r['count']) for e, r in routes])
+            metric('shop_sql_queries_total', 'counter', 'SQL statements executed.',
+                   [(f'{{endpoint="{e}"}}', r['queries']) for e, r in routes])
+            metric('shop_sql_seconds_total', 'counter', 'Time spent executing SQL.',
+                   [(f'{{endpoint="{e}"}}', r['sql']) for e, r in routes])
+            metric('shop_render_seconds_total', 'counter', 'Time spent rendering templates.',
+                   [(f'{{endpoint="{e}"}}', r['render']) for e, r in routes])
+            statements = sorted(self.statements.items(), key=lambda item: item[1], reverse=True)
+            metric('shop_sql_statement_max_seconds', 'gauge', 'Slowest SQL statements seen by this process.',
+                   [('{id="%08x",statement="%s"}' % (zlib.crc32(statement.encode()), prometheus_label(statement)), elapsed)
+                    for statement, elapsed in statements])
+            metric('shop_request_peak_memory_bytes', 'gauge', 'Largest per-request peak of traced Python memory.',
+                   [('', self.peak_memory)])
+        return '\n'.join(lines) + '\n'
+
+def prometheus_label(value):
+    value = ' '.join(value.split())[:200]
+    return value.replace('\\', '\\\\').replace('"', '\\"')
+
+request_metrics = RequestMetrics()
+
+def current_request_metrics():
+    if has_request_context():
+        return g.get('request_metrics')
+    return None
+
+def before_sql(conn, cursor, statement, parameters, context, executemany):
+    context.query_started = time.perf_counter()
+
+def after_sql(conn, cursor, statement, parameters, context, executemany):
+    metrics = current_request_metrics()
+    if metrics is None:
+        return
+    elapsed = time.perf_counter() - context.query_started
+    metrics['queries'] += 1
+    metrics['sql'] += elapsed
+    slowest = metrics['slowest']
+    slowest.append((elapsed, statement))
+    # Only the N slowest statements of the request are kept
+    if len(slowest) > app.config['PROFILING_SLOW_QUERIES']:
+        slowest.remove(min(slowest))
+
+def before_render(sender, template, context, **extra):
+    metrics = current_request_metrics()
+    if metrics is not None:
+        metrics['render_started'].append(time.perf_counter())
+
+def after_render(sender, template, context, **extra):
+    metrics = current_request_metrics()
+    if metrics is not None and metrics['render_started']:
+        metrics['render'] += time.perf_counter() - metrics['render_started'].pop()
+
+def start_request_metrics():
+    g.request_metrics = {'started': time.perf_counter(), 'queries': 0, 'sql': 0.0, 'slowest': [],
+                         'render': 0.0, 'render_started': []}
+    if tracemalloc.is_tracing():
+        # Process-wide peak: concurrent requests in other threads are included
+        tracemalloc.reset_peak()
+    if request.args.get('profile') == '1':
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another request is already being profiled
+            return
+        g.profiler = profiler
+
+def finish_request_metrics(response):
+    metrics = g.pop('request_metrics', None)
+    if metrics is None:
+        return response
+    duration = time.perf_counter() - metrics['started']
+    peak_memory = tracemalloc.get_traced_memory()[1] if tracemalloc.is_tracing() else 0
+    endpoint = request.endpoint or 'unmatched'
+    profiler = g.pop('profiler', None)
+    if profiler is not None:
+        profiler.disable()
+        os.makedirs(app.config['PROFILE_DIR'], exist_ok=True)
+        filename = f'{endpoint}-{datetime.now().strftime("%Y%m%d-%H%M%S-%f")}.prof'
+        profiler.dump_stats(os.path.join(app.config['PROFILE_DIR'], filename))
+        response.headers['X-Profile-Dump'] = filename
+    request_metrics.record(endpoint, duration, metrics['queries'], metrics['sql'], metrics['render'],
+                           metrics['slowest'], peak_memory)
+    timings = [
+        f'db;dur={metrics["sql"] * 1000:.1f};desc="{metrics["queries"]} queries"',
+        f'render;dur={metrics["render"] * 1000:.1f}',
+        f'app;dur={duration * 1000:.1f}'
+    ]
+    if peak_memory:
+        timings.append(f'mem;desc="peak {peak_memory / 1048576:.1f} MB"')
+    response.headers['Server-Timing'] = ', '.join(timings)
+    if metrics['queries'] > app.config['PROFILING_QUERY_WARNING']:
+        app.logger.warning('%s ran %d queries in %.1f ms; slowest: %s', request.path, metrics['queries'],
+                           metrics['sql'] * 1000, max(metrics['slowest'])[1])
+    return response
+
+if app.config['PROFILING_ENABLED']:
+    event.listen(Engine, 'before_cursor_execute', before_sql)
+    event.listen(Engine, 'after_cursor_execute', after_sql)
+    before_render_template.connect(before_render, app)
+    template_rendered.connect(after_render, app)
+    app.before_request(start_request_metrics)
+    app.after_request(finish_request_metrics)
+    if app.config['PROFILING_TRACE_MEMORY']:
+        tracemalloc.start()
+
+@app.route('/metrics')
+def metrics():
+    if not app.config['PROFILING_ENABLED']:
+        abort(404)
+    return Response(request_metrics.prometheus(), mimetype='text/plain; version=0.0.4')
+
+# ==================== RESPONSE CACHE ====================
+
+CACHE_TAGS = ('sales', 'products', 'customers', 'suppliers', 'expenses', 'alerts')
+
+class LRUCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            entry = self.entries.get(key)
+            if entry is None:
+                return None
+            value, expires_at = entry
+            if expires_at < time.monotonic():
+                del self.entries[key]
+                return None
+            self.entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, ttl):
+        with self.lock:
+            self.entries[key] = (value, time.monotonic() + ttl)
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+response_cache = LRUCache(app.config['CACHE_MAX_ENTRIES'])
+
+def cache_backend():
+    # Resolved on every use, so a backend configured after import takes effect
+    backend = app.config['CACHE_BACKEND']
+    if backend is None:
+        return response_cache
+    if isinstance(backend, str):
+        module, _, factory = backend.partition(':')
+        backend = app.config['CACHE_BACKEND'] = getattr(importlib.import_module(module), factory)()
+    return backend
+
+@on_startup
+def prepare_cache_versions():
+    existing_tags = {name for (name,) in db.session.query(CacheVersion.name)}
+    db.session.add_all(CacheVersion(name=tag) for tag in CACHE_TAGS if tag not in existing_tags)
+    db.session.commit()
+
+def bump_cache_version(*tags):
+    # Call inside the write transaction; the new versions become visible when it commits
+    CacheVersion.query.filter(CacheVersion.name.in_(tags)) \
+        .update({CacheVersion.version: CacheVersion.version + 1}, synchronize_session=False)
+
+def cached(*tags):
+    # Caches a rendered page keyed by endpoint, query args, today's date and the versions of its tags
+    def decorator(view):
+        @wraps(view)
+        def wrapper(*args, **kwargs):
+            if not app.config['CACHE_ENABLED']:
+                return view(*args, **kwargs)
+            versions = tuple(db.session.query(CacheVersion.name, CacheVersion.version)
+                             .filter(CacheVersion.name.in_(tags)).order_by(CacheVersion.name).all())
+            key = (request.endpoint, tuple(sorted(kwargs.items())), tuple(sorted(request.args.items(multi=True))),
+                   datetime.now().date(), versions)
+            backend = cache_backend()
+            response = backend.get(key)
+            if response is None:
+                response = view(*args, **kwargs)
+                if isinstance(response, str):
+                    backend.set(key, response, app.config['CACHE_TTL'])
+            return response
+        return wrapper
+    return decorator
+
+# ==================== SALES ARCHIVE ====================
+
+ARCHIVE_BATCH_SIZE = 1000
+
+# Schema of the per-year archive files. Product and customer names are copied in, so an archived ledger
+# reads the same as it did when it was archived and each file stands on its own
+archive_metadata = db.MetaData()
+
+archived_sale = db.Table(
+    'sale', archive_metadata,
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('receipt_number', db.String(50)),
+    db.Column('sale_date', db.DateTime, index=True),
+    db.Column('product_id', db.Integer),
+    db.Column('product_name', db.String(200)),
+    db.Column('category', db.String(50)),
+    db.Column('customer_id', db.Integer),
+    db.Column('customer_name', db.String(100)),
+    db.Column('quantity', db.Integer),
+    db.Column('unit_price', db.Float),
+    db.Column('total_amount', db.Float),
+    db.Column('profit', db.Float),
+    db.Column('payment_method', db.String(20)))
+
+archived_expense = db.Table(
+    'expense', archive_metadata,
+    db.Column('id', db.Integer, primary_key=True),
+    db.Column('date', db.Date, index=True),
+    db.Column('category', db.String(50)),
+    db.Column('description', db.String(200)),
+    db.Column('amount', db.Float))
+
+archived_customer_update = Customer.__table__.update() \
+    .where(Customer.__table__.c.id == db.bindparam('b_id')) \
+    .values(
+        lifetime_spend=db.func.coalesce(Customer.__table__.c.lifetime_spend, 0) + db.bindparam('b_spend'),
+        visit_count=db.func.coalesce(Customer.__table__.c.visit_count, 0) + db.bindparam('b_visits'),
+        last_purchase_at=db.func.coalesce(Customer.__table__.c.last_purchase_at, db.bindparam('b_last')))
+
+archived_category_update = CustomerCategorySpend.__table__.update() \
+    .where(CustomerCategorySpend.__table__.c.customer_id == db.bindparam('b_id'),
+           CustomerCategorySpend.__table__.c.category == db.bindparam('b_category')) \
+    .values(amount=CustomerCategorySpend.__table__.c.amount + db.bindparam('b_amount'),
+            quantity=CustomerCategorySpend.__table__.c.quantity + db.bindparam('b_quantity'))
+
+def next_month(day):
+    return (day.replace(day=28) + timedelta(days=4)).replace(day=1)
+
+@lru_cache(maxsize=None)
+def archive_engine(filename):
+    os.makedirs(app.config['ARCHIVE_DIR'], exist_ok=True)
+    engine = db.create_engine(f"sqlite:///{os.path.join(app.config['ARCHIVE_DIR'], filename)}")
+    archive_metadata.create_all(engine)
+    return engine
+
+def archived_until():
+    # First day after the archived months, or None; everything before it lives in the archive files
+    last = db.session.query(db.func.max(ArchivedMonth.month)).scalar()
+    return next_month(last) if last else None
+
+def archived_months(start_day=None, end_day=None):
+    query = ArchivedMonth.query
+    if start_day:
+        query = query.filter(ArchivedMonth.month >= start_day.replace(day=1))
+    if end_day:
+        query = query.filter(ArchivedMonth.month <= end_day)
+    return query.order_by(ArchivedMonth.month).all()
+
+def read_archives(filenames, statement):
+    for filename in filenames:
+        with archive_engine(filename).connect() as conn:
+            yield from conn.execution_options(yield_per=ARCHIVE_BATCH_SIZE).execute(statement)
+
+def archive_files(start_day=None, end_day=None):
+    return list(dict.fromkeys(month.filename for month in archived_months(start_day, end_day)))
+
+def archived_sales_rows(start_day=None, end_day=None):
+    # Same columns and order as sales_ledger_statement(); the files are listed up front, so the rows can be
+    # streamed after the request's session is gone
+    c = archived_sale.c
+    statement = db.select(c.receipt_number, c.sale_date, c.product_name, c.category, c.customer_name,
+                          c.quantity, c.unit_price, c.total_amount, c.profit, c.payment_method) \
+        .order_by(c.sale_date, c.id)
+    if start_day:
+        statement = statement.where(c.sale_date >= datetime.combine(start_day, datetime.min.time()))
+    if end_day:
+        statement = statement.where(c.sale_date < datetime.combine(end_day + timedelta(days=1), datetime.min.time()))
+    return read_archives(archive_files(start_day, end_day), statement)
+
+def archived_expense_statement(start_day=None, end_day=None):
+    c = archived_expense.c
+    statement = db.select(c.date, c.category, c.description, c.amount).order_by(c.date, c.id)
+    if start_day:
+        statement = statement.where(c.date >= start_day)
+    if end_day:
+        statement = statement.where(c.date <= end_day)
+    return statement
+
+def archived_expense_rows(start_day=None, end_day=None):
+    return read_archives(archive_files(start_day, end_day), archived_expense_statement(start_day, end_day))
+
+def archived_expense_total(start_day=None, end_day=None):
+    # Whole months come from their precomputed total; only a month cut by the range is summed from its file
+    total = 0
+    for month in archived_months(start_day, end_day):
+        last_day = next_month(month.month) - timedelta(days=1)
+        if (not start_day or start_day <= month.month) and (not end_day or last_day <= end_day):
+            total += month.expense_total
+        else:
+            statement = archived_expense_statement(max(start_day or month.month, month.month),
+                                                   min(end_day or last_day, last_day))
+            total += sum(amount for _, _, _, amount in read_archives([month.filename], statement))
+    return total
+
+def fold_archived_customer_stats():
+    # rebuild_customer_stats() only sees live sales; each archive file's per-customer totals are added on top
+    c = archived_sale.c
+    # Newest file first, so the first archived last purchase kept by the coalesce is the latest one
+    for filename in reversed(archive_files()):
+        with archive_engine(filename).connect() as conn:
+            customers = conn.execute(
+                db.select(c.customer_id, db.func.sum(c.total_amount), db.func.count(db.distinct(c.sale_date)),
+                          db.func.max(c.sale_date))
+                .where(c.customer_id.isnot(None)).group_by(c.customer_id))
+            for batch in customers.partitions(ARCHIVE_BATCH_SIZE):
+                # Archived months are older than any live sale, so a live last purchase always wins
+                db.session.execute(archived_customer_update, [
+                    {'b_id': customer_id, 'b_spend': spend, 'b_visits': visits, 'b_last': last}
+                    for customer_id, spend, visits, last in batch])
+            categories = conn.execute(
+                db.select(c.customer_id, db.func.coalesce(c.category, ''), db.func.sum(c.total_amount),
+                          db.func.sum(c.quantity))
+                .where(c.customer_id.isnot(None)).group_by(c.customer_id, db.func.coalesce(c.category, '')))
+            for batch in categories.partitions(ARCHIVE_BATCH_SIZE):
+                rows = {(customer_id, category): (amount, quantity) for customer_id, category, amount, quantity in batch}
+                existing = set(db.session.query(CustomerCategorySpend.customer_id, CustomerCategorySpend.category)
+                               .filter(CustomerCategorySpend.customer_id.in_({key[0] for key in rows})))
+                if existing & rows.keys():
+                    db.session.execute(archived_category_update, [
+                        {'b_id': key[0], 'b_category': key[1], 'b_amount': rows[key][0], 'b_quantity': rows[key][1]}
+                        for key in existing & rows.keys()])
+                customer_ids = {customer_id for (customer_id,) in db.session.query(Customer.id)
+                                .filter(Customer.id.in_({key[0] for key in rows.keys() - existing}))}
+                new_rows = [{'customer_id': key[0], 'category': key[1], 'amount': amount, 'quantity': quantity}
+                            for key, (amount, quantity) in rows.items() if key not in existing and key[0] in customer_ids]
+                if new_rows:
+                    db.session.execute(db.insert(CustomerCategorySpend), new_rows)
+
+def archive_month(month):
+    # Copies the month into its year's file, then deletes it from Sale/Expense in one main-database transaction.
+    # The file is written first, and a month that is archived again replaces its rows there, so an interrupted
+    # run can simply be repeated
+    start = datetime.combine(month, datetime.min.time())
+    end = datetime.combine(next_month(month), datetime.min.time())
+    sale_range = (Sale.sale_date >= start, Sale.sale_date < end)
+    expense_range = (Expense.date >= month, Expense.date < next_month(month))
+    filename = f'sales-{month.year}.db'
+    with archive_engine(filename).begin() as conn:
+        if not db.session.query(ArchivedMonth.query.filter_by(filename=filename).exists()).scalar():
+            # A file that no archived month points at is left over from an earlier database
+            conn.execute(archived_sale.delete())
+            conn.execute(archived_expense.delete())
+        conn.execute(archived_sale.delete().where(archived_sale.c.sale_date >= start, archived_sale.c.sale_date < end))
+        conn.execute(archived_expense.delete().where(archived_expense.c.date >= month,
+                                                     archived_expense.c.date < next_month(month)))
+        sales = db.session.execute(db.select(
+            Sale.id, Sale.receipt_number, Sale.sale_date, Sale.product_id, Product.name.label('product_name'),
+            Product.category, Sale.customer_id, Customer.name.label('customer_name'), Sale.quantity,
+            Sale.unit_price, Sale.total_amount, Sale.profit, Sale.payment_method
+        ).outerjoin(Product, Sale.product_id == Product.id).outerjoin(Customer, Sale.customer_id == Customer.id)
+            .filter(*sale_range).execution_options(yield_per=ARCHIVE_BATCH_SIZE))
+        for batch in sales.mappings().partitions():
+            conn.execute(archived_sale.insert(), [dict(row) for row in batch])
+        expenses = db.session.execute(db.select(Expense.id, Expense.date, Expense.category, Expense.description,
+                                                Expense.amount).filter(*expense_range))
+        for batch in expenses.mappings().partitions(ARCHIVE_BATCH_SIZE):
+            conn.execute(archived_expense.insert(), [dict(row) for row in batch])
+    sales = db.session.query(
+        db.func.count(Sale.id), db.func.coalesce(db.func.sum(Sale.total_amount), 0),
+        db.func.coalesce(db.func.sum(Sale.profit), 0), db.func.coalesce(db.func.sum(Sale.quantity), 0)
+    ).filter(*sale_range).one()
+    expenses = db.session.query(db.func.count(Expense.id), db.func.coalesce(db.func.sum(Expense.amount), 0)) \
+        .filter(*expense_range).one()
+    archived = ArchivedMonth(month=month, filename=filename, sale_count=sales[0], revenue=sales[1], profit=sales[2],
+                             quantity=sales[3], expense_count=expenses[0], expense_total=expenses[1])
+    db.session.add(archived)
+    Sale.query.filter(*sale_range).delete(synchronize_session=False)
+    Expense.query.filter(*expense_range).delete(synchronize_session=False)
+    bump_cache_version('sales', 'expenses')
+    db.session.commit()
+    return archived
+
+def archive_closed_months(keep_months):
+    # Archives, oldest first, every month that ended more than keep_months full months ago
+    cutoff = date.today().replace(day=1)
+    for _ in range(keep_months):
+        cutoff = (cutoff - timedelta(days=1)).replace(day=1)
+    first_sale = db.session.query(db.func.min(Sale.sale_date)).scalar()
+    first_expense = db.session.query(db.func.min(Expense.date)).scalar()
+    oldest = [day for day in (first_sale and first_sale.date(), first_expense) if day]
+    if not oldest:
+        return []
+    month = max(min(oldest).replace(day=1), archived_until() or date.min)
+    archived = []
+    while month < cutoff:
+        archived.append(archive_month(month))
+        month = next_month(month)
+    return archived
+
+@app.cli.command('archive-sales')
+@click.option('--keep-months', type=int, help='Full months to keep live (default: ARCHIVE_KEEP_MONTHS).')
+@click.option('--vacuum', is_flag=True, help='Give the freed space back to the filesystem (SQLite).')
+def archive_sales_command(keep_months, vacuum):
+    """Move closed months of sales and expenses into the per-year archive files."""
+    archived = archive_closed_months(app.config['ARCHIVE_KEEP_MONTHS'] if keep_months is None else keep_months)
+    for month in archived:
+        print(f'{month.month:%Y-%m}: {month.sale_count} sales, {month.expense_count} expenses -> {month.filename}')
+    print(f'{len(archived)} months archived; live data starts at {archived_until() or "the first sale"}')
+    if vacuum and db.engine.dialect.name == 'sqlite':
+        with db.engine.connect() as conn:
+            conn.execution_options(isolation_level='AUTOCOMMIT').exec_driver_sql('VACUUM')
+
+# ==================== DAILY SALES SUMMARY ====================
+
+def add_to_daily_summary(sale, category):
+    # Runs inside the caller's transaction so the rollup commits together with the sale
+    key = {
+        'day': sale.sale_date.date(),
+        'product_id': sale.product_id,
+        'category': category or '',
+        'payment_method': sale.payment_method or ''
+    }
+    updated = DailySalesSummary.query.filter_by(**key).update({
+        DailySalesSummary.revenue: DailySalesSummary.revenue + sale.total_amount,
+        DailySalesSummary.profit: DailySalesSummary.profit + sale.profit,
+        DailySalesSummary.quantity: DailySalesSummary.quantity + sale.quantity,
+        DailySalesSummary.sale_count: DailySalesSummary.sale_count + 1
+    }, synchronize_session=False)
+    if not updated:
+        db.session.add(DailySalesSummary(revenue=sale.total_amount, profit=sale.profit,
+                                         quantity=sale.quantity, sale_count=1, **key))
+
+def rebuild_daily_summary():
+    # Days of archived months keep their rollup rows: their sales are no longer in the Sale table
+    boundary = archived_until()
+    DailySalesSummary.query.filter(*([DailySalesSummary.day >= boundary] if boundary else [])) \
+        .delete(synchronize_session=False)
+    day = day_bucket(Sale.sale_date)
+    category = db.func.coalesce(Product.category, '')
+    payment_method = db.func.coalesce(Sale.payment_method, '')
+    rollup = db.select(
+        day,
+        Sale.product_id,
+        category,
+        payment_method,
+        db.func.sum(Sale.total_amount),
+        db.func.coalesce(db.func.sum(Sale.profit), 0),
+        db.func.sum(Sale.quantity),
+        db.func.count(Sale.id)
+    ).select_from(Sale).outerjoin(Product, Sale.product_id == Product.id) \
+        .group_by(day, Sale.product_id, category, payment_method)
+    db.session.execute(db.insert(DailySalesSummary).from_select(
+        ['day', 'product_id', 'category', 'payment_method', 'revenue', 'profit', 'quantity', 'sale_count'],
+        rollup))
+    bump_cache_version('sales')
+    db.session.commit()
+
+@app.cli.command('rebuild-daily-summary')
+def rebuild_daily_summary_command():
+    """Rebuild the daily sales rollup from the Sale table."""
+    rebuild_daily_summary()
+    print(f'Daily sales summary rebuilt: {DailySalesSummary.query.count()} rows')
+
+@on_startup
+def backfill_daily_summary():
+    # Backfill the rollup the first time it is created on a database that already has sales
+    if not db.session.query(DailySalesSummary.query.exists()).scalar() \
+            and db.session.query(Sale.query.exists()).scalar():
+        rebuild_daily_summary()
+
+# ==================== CUSTOMER STATS ====================
+
+CUSTOMER_TOP_CATEGORIES = 3
+RFM_SEGMENTS = ('champion', 'loyal', 'at_risk', 'big_spender', 'new', 'lost', 'regular')
+
+def add_to_customer_stats(sale, category):
+    # Runs inside the sale transaction. Basket lines share one sale_date, so they count as a single visit
+    if not sale.customer_id:
+        return
+    customer_id = int(sale.customer_id)
+    key = {'customer_id': customer_id, 'category': category or ''}
+    updated = CustomerCategorySpend.query.filter_by(**key).update({
+        CustomerCategorySpend.amount: CustomerCategorySpend.amount + sale.total_amount,
+        CustomerCategorySpend.quantity: CustomerCategorySpend.quantity + sale.quantity
+    }, synchronize_session=False)
+    if not updated:
+        db.session.add(CustomerCategorySpend(amount=sale.total_amount, quantity=sale.quantity, **key))
+    top = db.session.query(CustomerCategorySpend.category) \
+        .filter(CustomerCategorySpend.customer_id == customer_id, CustomerCategorySpend.category != '') \
+        .order_by(CustomerCategorySpend.amount.desc()).limit(CUSTOMER_TOP_CATEGORIES).all()
+    Customer.query.filter_by(id=customer_id).update({
+        Customer.lifetime_spend: db.func.coalesce(Customer.lifetime_spend, 0) + sale.total_amount,
+        Customer.visit_count: db.func.coalesce(Customer.visit_count, 0)
+        + db.case((Customer.last_purchase_at == sale.sale_date, 0), else_=1),
+        Customer.last_purchase_at: db.case((Customer.last_purchase_at > sale.sale_date, Customer.last_purchase_at),
+                                           else_=sale.sale_date),
+        Customer.top_categories: ', '.join(name for (name,) in top) or None,
+        # Properly scored by the customer-segments job; until then a first-time buyer is 'new'
+        Customer.rfm_segment: db.func.coalesce(Customer.rfm_segment, 'new')
+    }, synchronize_session=False)
+
+def rfm_cut_points(column, buyers):
+    # Quintile boundaries of column among customers who have bought something
+    return [db.session.query(column).filter(Customer.visit_count > 0).order_by(column)
+            .offset(buyers * k // 5).limit(1).scalar() for k in range(1, 5)]
+
+def rfm_score(column, cut_points):
+    return db.case(*((column >= cut, 5 - i) for i, cut in enumerate(reversed(cut_points))), else_=1)
+
+def refresh_customer_segments():
+    # RFM scores are relative to the whole customer base, so they are recomputed in bulk by a background job
+    buyers = db.session.query(db.func.count(Customer.id)).filter(Customer.visit_count > 0).scalar()
+    if buyers:
+        score = rfm_score(Customer.last_purchase_at, rfm_cut_points(Customer.last_purchase_at, buyers)) * 100 \
+            + rfm_score(Customer.visit_count, rfm_cut_points(Customer.visit_count, buyers)) * 10 \
+            + rfm_score(Customer.lifetime_spend, rfm_cut_points(Customer.lifetime_spend, buyers))
+        # Unchanged rows are skipped so updated_at (and the API's delta sync) only moves for real changes
+        Customer.query.filter(Customer.visit_count > 0, Customer.rfm_score.is_distinct_from(score)) \
+            .update({Customer.rfm_score: score}, synchronize_session=False)
+        recency, frequency, monetary = Customer.rfm_score // 100, Customer.rfm_score // 10 % 10, Customer.rfm_score % 10
+        segment = db.case(
+            (db.and_(recency >= 4, frequency >= 4, monetary >= 4), 'champion'),
+            (db.and_(recency >= 3, frequency >= 4), 'loyal'),
+            (db.and_(recency <= 2, frequency >= 3), 'at_risk'),
+            (db.and_(recency >= 3, monetary >= 4), 'big_spender'),
+            (db.and_(recency >= 4, frequency <= 2), 'new'),
+            (recency <= 2, 'lost'),
+            else_='regular')
+        Customer.query.filter(Customer.rfm_score.isnot(None), Customer.rfm_segment.is_distinct_from(segment)) \
+            .update({Customer.rfm_segment: segment}, synchronize_session=False)
+    bump_cache_version('customers')
+    db.session.commit()
+
+top_categories_update = db.update(Customer.__table__) \
+    .where(Customer.__table__.c.id == db.bindparam('b_id')) \
+    .values(top_categories=db.bindparam('b_top'))
+
+def rebuild_customer_stats():
+    CustomerCategorySpend.query.delete()
+    category = db.func.coalesce(Product.category, '')
+    db.session.execute(db.insert(CustomerCategorySpend).from_select(
+        ['customer_id', 'category', 'amount', 'quantity'],
+        db.select(Sale.customer_id, category, db.func.sum(Sale.total_amount), db.func.sum(Sale.quantity))
+        .select_from(Sale).join(Customer, Sale.customer_id == Customer.id)
+        .outerjoin(Product, Sale.product_id == Product.id).group_by(Sale.customer_id, category)))
+
+    def per_customer(aggregate):
+        return db.select(aggregate).where(Sale.customer_id == Customer.id).scalar_subquery()
+
+    Customer.query.update({
+        Customer.lifetime_spend: db.func.coalesce(per_customer(db.func.sum(Sale.total_amount)), 0),
+        Customer.visit_count: per_customer(db.func.count(db.distinct(Sale.sale_date))),
+        Customer.last_purchase_at: per_customer(db.func.max(Sale.sale_date)),
+        Customer.top_categories: None,
+        Customer.rfm_score: None,
+        Customer.rfm_segment: None
+    }, synchronize_session=False)
+    fold_archived_customer_stats()
+
+    rows = db.session.query(CustomerCategorySpend.customer_id, CustomerCategorySpend.category) \
+        .filter(CustomerCategorySpend.category != '') \
+        .order_by(CustomerCategorySpend.customer_id, CustomerCategorySpend.amount.desc()) \
+        .execution_options(yield_per=1000)
+    batch = []
+    for customer_id, name in rows:
+        if batch and batch[-1]['b_id'] == customer_id:
+            if batch[-1]['b_top'].count(', ') < CUSTOMER_TOP_CATEGORIES - 1:
+                batch[-1]['b_top'] += f', {name}'
+            continue
+        if len(batch) >= 1000:
+            db.session.execute(top_categories_update, batch)
+            batch = []
+        batch.append({'b_id': customer_id, 'b_top': name})
+    if batch:
+        db.session.execute(top_categories_update, batch)
+    refresh_customer_segments()
+
+@app.cli.command('rebuild-customer-stats')
+def rebuild_customer_stats_command():
+    """Rebuild customer spend, visits, top categories and RFM segments from the Sale table."""
+    rebuild_customer_stats()
+    print(f'Customer stats rebuilt for {Customer.query.filter(Customer.visit_count > 0).count()} customers')
+
+@on_startup
+def backfill_customer_stats():
+    if not db.session.query(CustomerCategorySpend.query.exists()).scalar() \
+            and db.session.query(Sale.query.join(Customer, Sale.customer_id == Customer.id).exists()).scalar():
+        rebuild_customer_stats()
+
+# ==================== STOCK LEDGER ====================
+
+OPEN_LOT = StockLot.quantity_remaining > db.literal_column('0')
+
+stock_receipt = Product.__table__.update() \
+    .where(Product.__table__.c.id == db.bindparam('b_id')) \
+    .values(
+        average_cost=(db.func.coalesce(Product.__table__.c.average_cost, db.bindparam('b_cost'))
+                      * Product.__table__.c.quantity + db.bindparam('b_quantity') * db.bindparam('b_cost'))
+        / (Product.__table__.c.quantity + db.bindparam('b_quantity')),
+        fifo_value=db.func.coalesce(Product.__table__.c.fifo_value, 0) + db.bindparam('b_quantity') * db.bindparam('b_cost'),
+        quantity=Product.__table__.c.quantity + db.bindparam('b_quantity'))
+
+def receive_stock(receipts, kind='receipt', moved_at=None):
+    # receipts: [{'product_id', 'quantity' (> 0), 'unit_cost'}]. Adds the stock, one lot and one movement per
+    # receipt, and folds the cost into the product's running valuation; all as executemany statements
+    if not receipts:
+        return
+    moved_at = moved_at or datetime.utcnow()
+    db.session.execute(db.insert(StockLot), [
+        {'product_id': r['product_id'], 'received_at': moved_at, 'quantity_received': r['quantity'],
+         'quantity_remaining': r['quantity'], 'unit_cost': r['unit_cost']} for r in receipts])
+    db.session.execute(db.insert(StockMovement), [
+        {'product_id': r['product_id'], 'moved_at': moved_at, 'kind': kind, 'quantity': r['quantity'],
+         'unit_cost': r['unit_cost'], 'total_cost': r['quantity'] * r['unit_cost'], 'reference': r.get('reference')}
+        for r in receipts])
+    db.session.execute(stock_receipt, [{'b_id': r['product_id'], 'b_quantity': r['quantity'], 'b_cost': r['unit_cost']}
+                                       for r in receipts])
+
+def consume_stock(product_id, quantity, kind, reference=None, moved_at=None):
+    # Takes quantity out of the oldest open lots and returns its cost under COSTING_METHOD. The caller has
+    # already decremented Product.quantity (for sales, that conditional UPDATE also serializes this)
+    remaining = quantity
+    fifo_cost = lot_cost = 0
+    # Every open lot holds at least one unit, so no more than `quantity` lots are needed
+    for lot in StockLot.query.filter(StockLot.product_id == product_id, OPEN_LOT) \
+            .order_by(StockLot.id).limit(quantity):
+        taken = min(remaining, lot.quantity_remaining)
+        lot.quantity_remaining -= taken
+        lot_cost += taken * lot.unit_cost
+        remaining -= taken
+        if not remaining:
+            break
+    average_cost, buying_price = db.session.query(Product.average_cost, Product.buying_price) \
+        .filter_by(id=product_id).one()
+    fallback_cost = average_cost if average_cost is not None else buying_price or 0
+    # Units the lots do not cover (stock that predates the ledger) are costed at the average
+    fifo_cost = lot_cost + remaining * fallback_cost
+    cost = fifo_cost if app.config['COSTING_METHOD'] == 'fifo' else quantity * fallback_cost
+    Product.query.filter_by(id=product_id).update(
+        {Product.fifo_value: db.func.coalesce(Product.fifo_value, 0) - lot_cost}, synchronize_session=False)
+    db.session.add(StockMovement(product_id=product_id, moved_at=moved_at or datetime.utcnow(), kind=kind,
+                                 quantity=-quantity, unit_cost=cost / quantity, total_cost=-cost, reference=reference))
+    return cost
+
+def write_off_stock(product_id, quantity, reference=None):
+    # Manual or bulk decrease; callers clamp quantity to the stock on hand
+    if quantity <= 0:
+        return
+    Product.query.filter_by(id=product_id).update({Product.quantity: Product.quantity - quantity},
+                                                  synchronize_session=False)
+    consume_stock(product_id, quantity, 'adjustment', reference=reference)
+
+def open_stock_ledger():
+    # Stock that existed before the ledger (or was loaded directly) becomes an opening lot at the buying price
+    unledgered = (Product.quantity > 0, ~db.exists().where(StockLot.product_id == Product.id))
+    cost = db.func.coalesce(Product.buying_price, 0)
+    # The lots go in last, as they are what marks a product as opened
+    Product.query.filter(*unledgered).update(
+        {Product.average_cost: cost, Product.fifo_value: Product.quantity * cost}, synchronize_session=False)
+    db.session.execute(db.insert(StockMovement).from_select(
+        ['product_id', 'kind', 'quantity', 'unit_cost', 'total_cost'],
+        db.select(Product.id, db.literal('opening'), Product.quantity, cost, Product.quantity * cost).where(*unledgered)))
+    db.session.execute(db.insert(StockLot).from_select(
+        ['product_id', 'quantity_received', 'quantity_remaining', 'unit_cost'],
+        db.select(Product.id, Product.quantity, Product.quantity, cost).where(*unledgered)))
+    db.session.commit()
+
+@app.cli.command('open-stock-ledger')
+def open_stock_ledger_command():
+    """Open a ledger lot for products whose stock was loaded outside the app."""
+    opened = StockLot.query.count()
+    open_stock_ledger()
+    print(f'Opened {StockLot.query.count() - opened} stock lots')
+
+@on_startup
+def backfill_stock_ledger():
+    # Open the ledger the first time it is created on a database that already has stock
+    if not db.session.query(StockLot.query.exists()).scalar() \
+            and db.session.query(Product.query.filter(Product.quantity > 0).exists()).scalar():
+        open_stock_ledger()
+
+# ==================== SALES PAGINATION ====================
+
+SALES_PAGE_SIZE = 50
+
+def encode_sale_cursor(sale):
+    return f'{sale.sale_date.isoformat()}_{sale.id}'
+
+def decode_sale_cursor(cursor):
+    try:
+        sale_date, sale_id = cursor.rsplit('_', 1)
+        return datetime.fromisoformat(sale_date), int(sale_id)
+    except (AttributeError, ValueError):
+        return None
+
+def paginate_sales(query, after=None, before=None, per_page=SALES_PAGE_SIZE):
+    # Keyset pagination on (sale_date, id), newest first, with product and customer eager-loaded
+    query = query.options(db.joinedload(Sale.product), db.joinedload(Sale.customer))
+    key = db.tuple_(Sale.sale_date, Sale.id)
+    before_key = decode_sale_cursor(before)
+    after_key = decode_sale_cursor(after)
+    if before_key:
+        rows = query.filter(key > before_key) \
+            .order_by(Sale.sale_date.asc(), Sale.id.asc()).limit(per_page + 1).all()
+        has_newer = len(rows) > per_page
+        sales = rows[:per_page][::-1]
+        has_older = True
+    else:
+        if after_key:
+            query = query.filter(key < after_key)
+        rows = query.order_by(Sale.sale_date.desc(), Sale.id.desc()).limit(per_page + 1).all()
+        has_older = len(rows) > per_page
+        sales = rows[:per_page]
+        has_newer = after_key is not None
+    return {
+        'sales': sales,
+        'next_cursor': encode_sale_cursor(sales[-1]) if sales and has_older else None,
+        'prev_cursor': encode_sale_cursor(sales[0]) if sales and has_newer else None,
+    }
+
+# ==================== AGGREGATES ====================
+
+def day_range(start_day, end_day):
+    # Half-open datetime bounds covering whole days, so filters stay index-friendly
+    return (Sale.sale_date >= datetime.combine(start_day, datetime.min.time()),
+            Sale.sale_date < datetime.combine(end_day + timedelta(days=1), datetime.min.time()))
+
+def report_date_range():
+    # start_date/end_date query args shared by /reports and the exports
+    start_date = request.args.get('start_date')
+    end_date = request.args.get('end_date')
+    start_day = datetime.strptime(start_date, '%Y-%m-%d').date() if start_date else None
+    end_day = datetime.strptime(end_date, '%Y-%m-%d').date() if end_date else None
+    return start_day, end_day
+
+def sale_date_criteria(start_day=None, end_day=None):
+    criteria = []
+    if start_day:
+        criteria.append(day_range(start_day, start_day)[0])
+    if end_day:
+        criteria.append(day_range(end_day, end_day)[1])
+    return criteria
+
+def summary_range(start_day=None, end_day=None):
+    criteria = []
+    if start_day:
+        criteria.append(DailySalesSummary.day >= start_day)
+    if end_day:
+        criteria.append(DailySalesSummary.day <= end_day)
+    return criteria
+
+def sales_totals(start_day=None, end_day=None):
+    row = db.session.query(
+        db.func.coalesce(db.func.sum(DailySalesSummary.revenue), 0).label('revenue'),
+        db.func.coalesce(db.func.sum(DailySalesSummary.profit), 0).label('profit'),
+        db.func.coalesce(db.func.sum(DailySalesSummary.quantity), 0).label('quantity'),
+        db.func.coalesce(db.func.sum(DailySalesSummary.sale_count), 0).label('count')
+    ).filter(*summary_range(start_day, end_day)).one()
+    return {'revenue': row.revenue, 'profit': row.profit, 'quantity': row.quantity, 'count': row.count}
+
+def expense_total(start_day=None, end_day=None):
+    criteria = []
+    if start_day:
+        criteria.append(Expense.date >= start_day)
+    if end_day:
+        criteria.append(Expense.date <= end_day)
+    live = db.session.query(db.func.coalesce(db.func.sum(Expense.amount), 0)).filter(*criteria).scalar()
+    return live + archived_expense_total(start_day, end_day)
+
+def sales_by_day(start_day, end_day):
+    rows = db.session.query(
+        DailySalesSummary.day,
+        db.func.sum(DailySalesSummary.revenue).label('revenue'),
+        db.func.sum(DailySalesSummary.profit).label('profit'),
+        db.func.sum(DailySalesSummary.quantity).label('quantity')
+    ).filter(*summary_range(start_day, end_day)).group_by(DailySalesSummary.day).all()
+    by_day = {r.day: r for r in rows}
+    breakdown = {}
+    for i in range((end_day - start_day).days + 1):
+        current = start_day + timedelta(days=i)
+        r = by_day.get(current)
+        breakdown[current] = {
+            'revenue': r.revenue if r else 0,
+            'profit': r.profit if r else 0,
+            'quantity': r.quantity if r else 0
+        }
+    return breakdown
+
+def sales_by_category(start_day=None, end_day=None):
+    rows = db.session.query(
+        DailySalesSummary.category,
+        db.func.sum(DailySalesSummary.revenue).label('amount')
+    ).filter(*summary_range(start_day, end_day)).group_by(DailySalesSummary.category) \
+        .order_by(db.func.sum(DailySalesSummary.revenue).desc()).all()
+    breakdown = {}
+    for r in rows:
+        cat = r.category or 'Other'
+        breakdown[cat] = breakdown.get(cat, 0) + r.amount
+    return breakdown
+
+def sales_by_payment_method(start_day=None, end_day=None):
+    rows = db.session.query(
+        DailySalesSummary.payment_method,
+        db.func.sum(DailySalesSummary.revenue).label('amount')
+    ).filter(*summary_range(start_day, end_day)).group_by(DailySalesSummary.payment_method) \
+        .order_by(db.func.sum(DailySalesSummary.revenue).desc()).all()
+    breakdown = {}
+    for r in rows:
+        method = r.payment_method or 'unknown'
+        breakdown[method] = breakdown.get(method, 0) + r.amount
+    return breakdown
+
+def top_products(limit=5):
+    rows = db.session.query(
+        Product.name,
+        Product.category,
+        db.func.sum(DailySalesSummary.quantity).label('total_sold')
+    ).join(DailySalesSummary, DailySalesSummary.product_id == Product.id) \
+        .group_by(Product.id).order_by(db.func.sum(DailySalesSummary.quantity).desc()).limit(limit).all()
+    # List of dicts for easy template access
+    return [{'name': r.name, 'category': r.category, 'quantity': r.total_sold} for r in rows]
+
+# ==================== SALE TRANSACTIONS ====================
+
+SALE_RETRIES = 5
+
+def next_receipt_number():
+    # The UPDATE takes the write lock, so the value read back belongs to this transaction alone
+    ReceiptCounter.query.filter_by(id=1).update({ReceiptCounter.value: ReceiptCounter.value + 1},
+                                                synchronize_session=False)
+    value = db.session.query(ReceiptCounter.value).filter_by(id=1).scalar()
+    return f'RCP-{datetime.now().strftime("%Y%m%d")}-{value:06d}'
+
+def create_sale_line(product_id, quantity, customer_id, payment_method, receipt_number, sale_date):
+    # Conditional decrement: returns None instead of overselling when stock ran out concurrently
+    updated = Product.query.filter(Product.id == product_id, Product.quantity >= quantity) \
+        .update({Product.quantity: Product.quantity - quantity}, synchronize_session=False)
+    if not updated:
+        return None
+    product = db.session.get(Product, product_id, populate_existing=True)
+    cost = consume_stock(product_id, quantity, 'sale', reference=receipt_number, moved_at=sale_date)
+    sale = Sale(
+        sale_date=sale_date,
+        product_id=product_id,
+        customer_id=customer_id,
+        quantity=quantity,
+        unit_price=product.selling_price,
+        total_amount=product.selling_price * quantity,
+        payment_method=payment_method,
+        receipt_number=receipt_number,
+        profit=product.selling_price * quantity - cost
+    )
+    db.session.add(sale)
+    add_to_daily_summary(sale, product.category)
+    add_to_customer_stats(sale, product.category)
+    update_stock_alerts([product_id])
+    bump_cache_version('sales', 'products', 'customers')
+    return sale
+
+def receipt_lines(receipt_number):
+    # A basket's lines are numbered RCP-.../1, RCP-.../2, ...; the range keeps the lookup on the unique index
+    return Sale.query.options(db.joinedload(Sale.product), db.joinedload(Sale.customer)).filter(db.or_(
+        Sale.receipt_number == receipt_number,
+        Sale.receipt_number.between(f'{receipt_number}/', f'{receipt_number}/~')
+    )).order_by(Sale.id).all()
+
+def run_sale_transaction(work, retries=SALE_RETRIES):
+    # Retries the whole unit of work when SQLite reports the database as busy/locked
+    for attempt in range(retries):
+        try:
+            result = work()
+            if result is None:
+                db.session.rollback()
+            else:
+                db.session.commit()
+            return result
+        except OperationalError as e:
+            db.session.rollback()
+            if ('locked' not in str(e.orig) and 'busy' not in str(e.orig)) or attempt == retries - 1:
+                raise
+            time.sleep(0.05 * 2 ** attempt)
+
+# ==================== STOCK ALERTS ====================
+
+LEAD_TIME_UNITS = {'day': 1, 'week': 7, 'month': 30}
+
+def lead_time_days(delivery_time):
+    # Supplier.delivery_time is free text ('3 days', '2-3 days', '1 week'); ranges use their upper bound
+    match = re.search(r'(\d+)(?:\s*-\s*(\d+))?\s*(day|week|month)?', (delivery_time or '').lower())
+    if not match:
+        return app.config['DEFAULT_LEAD_TIME_DAYS']
+    return int(match.group(2) or match.group(1)) * LEAD_TIME_UNITS[match.group(3) or 'day']
+
+# Product columns besides the stock that a product's alert rows depend on
+STOCK_ALERT_COLUMNS = {'category', 'reorder_level', 'expiry_date', 'supplier_id'}
+
+def stock_alert_rows(product_ids=None):
+    # Yields StockAlert rows for every product, or only the given ones
+    today = datetime.now().date()
+    velocity_days = app.config['REORDER_VELOCITY_DAYS']
+    expiry_cutoff = today + timedelta(days=app.config['EXPIRY_WARNING_DAYS'])
+    sold = db.session.query(
+        DailySalesSummary.product_id,
+        db.func.sum(DailySalesSummary.quantity).label('quantity')
+    ).filter(DailySalesSummary.day >= today - timedelta(days=velocity_days))
+    products = []
+    if product_ids is not None:
+        sold = sold.filter(DailySalesSummary.product_id.in_(product_ids))
+        products.append(Product.id.in_(product_ids))
+    sold = sold.group_by(DailySalesSummary.product_id).subquery()
+    # Only products that can appear on a list are read: already low, expiring, or selling
+    rows = db.session.query(
+        Product.id, Product.name, Product.category, Product.quantity, Product.reorder_level,
+        Product.expiry_date, Supplier.delivery_time, sold.c.quantity.label('sold')
+    ).outerjoin(Supplier, Product.supplier_id == Supplier.id) \
+        .outerjoin(sold, sold.c.product_id == Product.id).filter(*products, db.or_(
+            Product.quantity <= Product.reorder_level,
+            db.and_(Product.expiry_date <= expiry_cutoff, Product.quantity > 0),
+            sold.c.quantity > 0
+        )).execution_options(yield_per=1000)
+
+    for r in rows:
+        quantity = r.quantity or 0
+        reorder_level = r.reorder_level or 0
+        daily_sales = (r.sold or 0) / velocity_days
+        lead_time = lead_time_days(r.delivery_time)
+        alert = {'product_id': r.id, 'name': r.name, 'category': r.category, 'quantity': quantity,
+                 'reorder_level': reorder_level, 'expiry_date': r.expiry_date,
+                 'daily_sales': round(daily_sales, 2), 'lead_time_days': lead_time, 'suggested_quantity': None}
+        if quantity <= reorder_level:
+            yield dict(alert, kind='low_stock', rank=quantity - reorder_level)
+        if r.expiry_date and r.expiry_date <= expiry_cutoff and quantity > 0:
+            yield dict(alert, kind='near_expiry', rank=r.expiry_date.toordinal())
+        # Reorder point covers the supplier's lead time on top of the safety stock (reorder level)
+        reorder_point = reorder_level + daily_sales * lead_time
+        if quantity <= reorder_point:
+            suggested = math.ceil(reorder_point + daily_sales * app.config['REORDER_COVER_DAYS']) - quantity
+            if suggested > 0:
+                days_left = quantity / daily_sales if daily_sales else quantity - reorder_level
+                yield dict(alert, kind='reorder', rank=days_left, suggested_quantity=suggested)
+
+def insert_stock_alerts(alerts):
+    batch = []
+    for alert in alerts:
+        batch.append(alert)
+        if len(batch) >= 1000:
+            db.session.execute(StockAlert.__table__.insert(), batch)
+            batch = []
+    if batch:
+        db.session.execute(StockAlert.__table__.insert(), batch)
+
+def refresh_stock_alerts():
+    # Full rescan; also picks up what changes with the date alone (expiry window, sales velocity)
+    StockAlert.query.delete()
+    insert_stock_alerts(stock_alert_rows())
+    bump_cache_version('alerts')
+    db.session.commit()
+
+def update_stock_alerts(product_ids):
+    # Call inside the write transaction of anything that changes these products' stock or alert settings
+    product_ids = list(product_ids)
+    if not product_ids:
+        return
+    StockAlert.query.filter(StockAlert.product_id.in_(product_ids)).delete(synchronize_session=False)
+    insert_stock_alerts(stock_alert_rows(product_ids))
+    bump_cache_version('alerts')
+
+# ==================== BACKGROUND JOBS ====================
+
+# name -> (function, config key holding its interval in seconds)
+BACKGROUND_JOBS = {
+    'stock-alerts': (refresh_stock_alerts, 'STOCK_ALERT_INTERVAL'),
+    'customer-segments': (refresh_customer_segments, 'CUSTOMER_SEGMENT_INTERVAL')
+}
+
+def claim_job(name, interval):
+    # Conditional UPDATE: of several workers polling at once, exactly one gets the row
+    now = datetime.utcnow()
+    claimed = JobRun.query.filter(JobRun.name == name, db.or_(
+        JobRun.last_started_at.is_(None),
+        JobRun.last_started_at <= now - timedelta(seconds=interval)
+    )).update({JobRun.last_started_at: now}, synchronize_session=False)
+    db.session.commit()
+    return bool(claimed)
+
+def run_job(name):
+    # The caller has claimed the job
+    job = BACKGROUND_JOBS[name][0]
+    started = time.perf_counter()
+    error = None
+    try:
+        job()
+    except Exception as e:
+        db.session.rollback()
+        error = repr(e)
+        app.logger.exception('Background job %s failed', name)
+    JobRun.query.filter_by(name=name).update({
+        JobRun.last_finished_at: datetime.utcnow(),
+        JobRun.last_duration: time.perf_counter() - started,
+        JobRun.last_error: error
+    }, synchronize_session=False)
+    db.session.commit()
+
+def run_due_jobs(force=False):
+    for name, (job, interval_key) in BACKGROUND_JOBS.items():
+        if claim_job(name, 0 if force else app.config[interval_key]):
+            run_job(name)
+
+def run_jobs_forever():
+    while True:
+        with app.app_context():
+            try:
+                run_due_jobs()
+            except OperationalError:
+                app.logger.exception('Background job poll failed')
+        time.sleep(app.config['JOB_POLL_SECONDS'])
+
+def start_background_jobs():
+    thread = threading.Thread(target=run_jobs_forever, name='background-jobs', daemon=True)
+    thread.start()
+    return thread
+
+@app.cli.command('run-jobs')
+@click.option('--once', is_flag=True, help='Run every job now and exit instead of polling.')
+def run_jobs_command(once):
+    """Run the background jobs (stock alerts) as a standalone worker."""
+    if once:
+        run_due_jobs(force=True)
+        for job in JobRun.query.order_by(JobRun.name):
+            print(f'{job.name}: {job.last_duration:.2f}s {job.last_error or "ok"}')
+    else:
+        run_jobs_forever()
+
+@on_startup
+def prepare_jobs():
+    existing_jobs = {name for (name,) in db.session.query(JobRun.name)}
+    db.session.add_all(JobRun(name=name) for name in BACKGROUND_JOBS if name not in existing_jobs)
+    db.session.commit()
+    # Run new jobs once up front so their results exist before the first poll
+    if db.session.query(JobRun.query.filter(JobRun.last_finished_at.is_(None)).exists()).scalar():
+        run_due_jobs()
+
+if app.config['BACKGROUND_JOBS']:
+    start_background_jobs()
+
+# ==================== REPORT WORKERS ====================
+
+report_pool = ThreadPoolExecutor(app.config['REPORT_WORKERS'] or 1, thread_name_prefix='report')
+report_slots = threading.BoundedSemaphore(app.config['REPORT_WORKERS'] + app.config['REPORT_QUEUE'])
+
+def in_report_pool(view):
+    # The view runs in report_pool under a copy of the request's context (same request, g and session) while
+    # the request thread waits, so however many server threads are free, at most REPORT_WORKERS report scans
+    # compete with the sale path for the database
+    @wraps(view)
+    def wrapper(*args, **kwargs):
+        # cProfile only sees the thread it was enabled in, so a ?profile=1 request runs where its profiler is
+        if not app.config['REPORT_WORKERS'] or g.get('profiler') is not None:
+            return view(*args, **kwargs)
+        if not report_slots.acquire(blocking=False):
+            return Response('Reports are busy, please try again shortly.', 503, {'Retry-After': '5'})
+        try:
+            return report_pool.submit(contextvars.copy_context().run, view, *args, **kwargs).result()
+        finally:
+            report_slots.release()
+    return wrapper
 
 # ==================== DASHBOARD ====================
 
+def stock_alerts(kind, limit=5):
+    return StockAlert.query.filter_by(kind=kind).order_by(StockAlert.rank, StockAlert.product_id).limit(limit).all()
+
 @app.route('/')
+@cached('sales', 'products', 'customers', 'suppliers', 'alerts')
 def index():
     total_products = Product.query.count()
-    low_stock = Product.query.filter(Product.quantity <= Product.reorder_level).count()
+    # Alert lists are precomputed; see refresh_stock_alerts() and update_stock_alerts()
+    low_stock = StockAlert.query.filter_by(kind='low_stock').count()
+    near_expiry = StockAlert.query.filter_by(kind='near_expiry').count()
     total_customers = Customer.query.count()
     total_suppliers = Supplier.query.count()
     today = datetime.now().date()
-    today_sales = Sale.query.filter(db.func.date(Sale.sale_date) == today).all()
-    today_revenue = sum(s.total_amount for s in today_sales)
-    today_profit = sum(s.profit for s in today_sales)
-    recent_sales = Sale.query.order_by(Sale.sale_date.desc()).limit(5).all()
-    low_stock_products = Product.query.filter(Product.quantity <= Product.reorder_level).limit(5).all()
+    today_totals = sales_totals(today, today)
+    recent_sales = Sale.query.options(db.joinedload(Sale.product)) \
+        .order_by(Sale.sale_date.desc(), Sale.id.desc()).limit(5).all()
+    low_stock_products = stock_alerts('low_stock')
+    near_expiry_products = stock_alerts('near_expiry')
+    reorder_suggestions = stock_alerts('reorder')
+    alerts_updated_at = db.session.query(JobRun.last_finished_at).filter_by(name='stock-alerts').scalar()
     return render_template('index.html',
                            total_products=total_products,
                            low_stock=low_stock,
+                           near_expiry=near_expiry,
                            total_customers=total_customers,
                            total_suppliers=total_suppliers,
-                           today_revenue=today_revenue,
-                           today_profit=today_profit,
+                           today_revenue=today_totals['revenue'],
+                           today_profit=today_totals['profit'],
                            recent_sales=recent_sales,
-                           low_stock_products=low_stock_products)
+                           low_stock_products=low_stock_products,
+                           near_expiry_products=near_expiry_products,
+                           reorder_suggestions=reorder_suggestions,
+                           alerts_updated_at=alerts_updated_at)
 
 # ==================== INVENTORY ====================
 
+@app.route('/inventory/valuation')
+@read_only
+def inventory_valuation():
+    # Reads only the running per-product valuation, so the cost is independent of the movement history
+    category = db.func.coalesce(Product.category, '')
+    rows = db.session.query(
+        category.label('category'),
+        db.func.coalesce(db.func.sum(Product.quantity), 0).label('units'),
+        db.func.coalesce(db.func.sum(Product.fifo_value), 0).label('fifo_value'),
+        db.func.coalesce(db.func.sum(Product.quantity * db.func.coalesce(Product.average_cost, Product.buying_price)),
+                         0).label('average_value'),
+        db.func.coalesce(db.func.sum(Product.quantity * Product.selling_price), 0).label('retail_value')
+    ).filter(Product.quantity > 0).group_by(category).order_by(category).all()
+    categories = [{'category': r.category or 'Other', 'units': r.units, 'fifo_value': round(r.fifo_value, 2),
+                   'average_value': round(r.average_value, 2), 'retail_value': round(r.retail_value, 2)}
+                  for r in rows]
+    return jsonify({
+        'costing_method': app.config['COSTING_METHOD'],
+        'units': sum(c['units'] for c in categories),
+        'fifo_value': round(sum(c['fifo_value'] for c in categories), 2),
+        'average_value': round(sum(c['average_value'] for c in categories), 2),
+        'retail_value': round(sum(c['retail_value'] for c in categories), 2),
+        'categories': categories
+    })
+
 @app.route('/inventory')
 def inventory():
     products = Product.query.all()
@@ -116,12 +1595,19 @@ def add_product():
         category=request.form.get('category'),
         buying_price=float(request.form.get('buying_price', 0)),
         selling_price=float(request.form.get('selling_price', 0)),
-        quantity=int(request.form.get('quantity', 0)),
+        quantity=0,
         reorder_level=int(request.form.get('reorder_level', 10)),
         supplier_id=request.form.get('supplier_id') or None,
         expiry_date=datetime.strptime(expiry_date, '%Y-%m-%d').date() if expiry_date else None
     )
     db.session.add(product)
+    db.session.flush()
+    # Opening stock goes through the ledger as the product's first lot
+    quantity = int(request.form.get('quantity', 0))
+    if quantity > 0:
+        receive_stock([{'product_id': product.id, 'quantity': quantity, 'unit_cost': product.buying_price}], 'opening')
+    update_stock_alerts([product.id])
+    bump_cache_version('products')
     db.session.commit()
     flash('Product added successfully!', 'success')
     return redirect(url_for('inventory'))
@@ -131,9 +1617,15 @@ def update_stock(id):
     product = Product.query.get_or_404(id)
     if request.method == 'POST':
         quantity_change = int(request.form.get('quantity_change', 0))
-        product.quantity += quantity_change
-        if product.quantity < 0:
-            product.quantity = 0
+        if quantity_change > 0:
+            # A receipt at a new unit cost also becomes the product's current buying price
+            if request.form.get('unit_cost'):
+                product.buying_price = float(request.form['unit_cost'])
+            receive_stock([{'product_id': id, 'quantity': quantity_change, 'unit_cost': product.buying_price or 0}])
+        elif quantity_change < 0:
+            write_off_stock(id, min(-quantity_change, product.quantity))
+        update_stock_alerts([id])
+        bump_cache_version('products')
         db.session.commit()
         flash(f'Stock updated! New quantity: {product.quantity}', 'success')
         return redirect(url_for('inventory'))
@@ -142,58 +1634,369 @@ def update_stock(id):
 @app.route('/delete_product/<int:id>', methods=['POST'])
 def delete_product(id):
     product = Product.query.get_or_404(id)
+    StockLot.query.filter_by(product_id=id).delete()
     db.session.delete(product)
+    db.session.add(DeletedRecord(kind='product', record_id=id))
+    db.session.flush()
+    update_stock_alerts([id])
+    bump_cache_version('products')
     db.session.commit()
     flash('Product deleted.', 'success')
     return redirect(url_for('inventory'))
 
+# ==================== BULK IMPORT ====================
+
+IMPORT_BATCH_SIZE = 1000
+IMPORT_MAX_ERRORS = 1000
+# Imported products are matched to existing ones on these columns
+IMPORT_MATCH_KEY = ('name', 'brand')
+
+def parse_date(value):
+    return datetime.strptime(value, '%Y-%m-%d').date()
+
+PRODUCT_IMPORT_FIELDS = {
+    'name': str,
+    'brand': str,
+    'category': str,
+    'buying_price': float,
+    'selling_price': float,
+    'quantity': int,
+    'reorder_level': int,
+    'supplier_id': int,
+    'expiry_date': parse_date
+}
+
+def json_record(value):
+    return value if isinstance(value, dict) else ValueError('expected a JSON object')
+
+def read_import_records():
+    # Yields (row number, dict) from an uploaded CSV / JSON / JSON Lines file or the raw request body.
+    # A JSON Lines row that cannot be read yields a ValueError in place of its dict, so the rest still loads
+    upload = request.files.get('file')
+    filename = upload.filename if upload else ''
+    content_type = upload.mimetype if upload else request.mimetype
+    stream = io.TextIOWrapper(upload.stream if upload else request.stream, encoding='utf-8-sig')
+    if filename.endswith('.csv') or content_type == 'text/csv':
+        yield from enumerate(csv.DictReader(stream), 1)
+        return
+    lines = (line for line in stream if line.strip())
+    first_line = next(lines, '')
+    if first_line.lstrip().startswith('['):
+        # A plain JSON array has to be parsed whole; JSON Lines is read one record at a time
+        for row_number, value in enumerate(json.loads(first_line + stream.read()), 1):
+            yield row_number, json_record(value)
+        return
+    for row_number, line in enumerate(chain([first_line] if first_line else [], lines), 1):
+        try:
+            yield row_number, json_record(json.loads(line))
+        except json.JSONDecodeError as e:
+            yield row_number, ValueError(f'invalid JSON: {e.msg} at column {e.colno}')
+
+def parse_product_record(record):
+    values = {}
+    for field, convert in PRODUCT_IMPORT_FIELDS.items():
+        raw = record.get(field)
+        if raw is None or str(raw).strip() == '':
+            continue
+        try:
+            values[field] = convert(str(raw).strip()) if convert in (str, parse_date) else convert(raw)
+        except (TypeError, ValueError):
+            raise ValueError(f'invalid {field}: {raw!r}')
+    if not values.get('name'):
+        raise ValueError('name is required')
+    for field in ('buying_price', 'selling_price', 'quantity', 'reorder_level'):
+        if values.get(field, 0) < 0:
+            raise ValueError(f'{field} cannot be negative')
+    return values
+
+def product_ids_by_key(keys):
+    # Maps (name, brand) to the oldest matching product; a missing brand matches an empty one
+    ids = {}
+    names = {name for name, brand in keys}
+    rows = db.session.query(Product.id, Product.name, Product.brand) \
+        .filter(Product.name.in_(names)).order_by(Product.id)
+    for product_id, name, brand in rows:
+        ids.setdefault((name, brand or ''), product_id)
+    return ids
+
+def upsert_product_batch(batch):
+    existing = product_ids_by_key(batch.keys())
+    # Quantities are not written directly: the difference to the stock on hand goes through the ledger
+    quantities = {key: values.pop('quantity') for key, values in batch.items() if 'quantity' in values}
+    inserts = [{**values, 'quantity': 0} for key, values in batch.items() if key not in existing]
+    # Name and brand are what matched, so updates leave them (and with them the search index) alone
+    updated = [(existing[key], values) for key, values in batch.items() if key in existing]
+    updates = [{'id': product_id, **{column: value for column, value in values.items()
+                                     if column not in IMPORT_MATCH_KEY}} for product_id, values in updated]
+    updates = [values for values in updates if len(values) > 1]
+    # Stock alerts are rewritten only for products whose alert settings actually change
+    alerted = [product_id for product_id, values in updated if STOCK_ALERT_COLUMNS & values.keys()]
+    if alerted:
+        current = {row.id: row for row in db.session.query(Product.id, *(getattr(Product, column)
+                   for column in STOCK_ALERT_COLUMNS)).filter(Product.id.in_(alerted))}
+        alerted = [product_id for product_id, values in updated if any(
+            column in values and values[column] != getattr(current[product_id], column)
+            for column in STOCK_ALERT_COLUMNS)]
+    on_hand = {}
+    if existing:
+        on_hand = {product_id: (quantity, buying_price) for product_id, quantity, buying_price in
+                   db.session.query(Product.id, Product.quantity, Product.buying_price)
+                   .filter(Product.id.in_([existing[key] for key in quantities if key in existing]))}
+    # ORM bulk INSERT / UPDATE by primary key, each sent as one executemany per set of columns
+    if inserts:
+        db.session.execute(db.insert(Product), inserts)
+    if updates:
+        db.session.execute(db.update(Product), updates)
+    ids = {**existing, **product_ids_by_key([key for key in batch if key not in existing])}
+    receipts = []
+    alerted += [ids[key] for key in batch if key not in existing]
+    for key, quantity in quantities.items():
+        current, buying_price = on_hand.get(ids[key], (0, 0))
+        change = quantity - (current or 0)
+        if change:
+            alerted.append(ids[key])
+        if change > 0:
+            receipts.append({'product_id': ids[key], 'quantity': change,
+                             'unit_cost': batch[key].get('buying_price', buying_price or 0)})
+        elif change < 0:
+            write_off_stock(ids[key], -change, reference='import')
+    receive_stock(receipts, 'import')
+    update_stock_alerts(set(alerted))
+    return len(inserts), len(updated)
+
+def import_error(errors, row_number, message):
+    if len(errors) < IMPORT_MAX_ERRORS:
+        errors.append({'row': row_number, 'error': message})
+
+@app.route('/import_products', methods=['POST'])
+def import_products():
+    inserted = updated = error_count = 0
+    errors = []
+    batch = {}
+    try:
+        for row_number, record in read_import_records():
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                values = parse_product_record(record)
+            except (AttributeError, ValueError) as e:
+                error_count += 1
+                import_error(errors, row_number, str(e))
+                continue
+            # Later rows for the same name+brand replace earlier ones
+            batch[(values['name'], values.get('brand') or '')] = values
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                counts = upsert_product_batch(batch)
+                inserted += counts[0]
+                updated += counts[1]
+                batch = {}
+        if batch:
+            counts = upsert_product_batch(batch)
+            inserted += counts[0]
+            updated += counts[1]
+    except (csv.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        db.session.rollback()
+        return jsonify({'error': f'Could not parse upload: {e}'}), 400
+    bump_cache_version('products')
+    db.session.commit()
+    return jsonify({'inserted': inserted, 'updated': updated, 'error_count': error_count, 'errors': errors})
+
+def adjust_stock_batch(batch, errors):
+    # batch: {product id or (name, brand): [change, first row number]}
+    keyed = [key for key in batch if isinstance(key, tuple)]
+    ids = product_ids_by_key(keyed) if keyed else {}
+    known = {product_id for (product_id,) in db.session.query(Product.id)
+             .filter(Product.id.in_([key for key in batch if not isinstance(key, tuple)]))}
+    changes = {}
+    failed = 0
+    for key, (change, row_number) in batch.items():
+        product_id = ids.get(key) if isinstance(key, tuple) else key if key in known else None
+        if product_id is None:
+            failed += 1
+            import_error(errors, row_number, f'unknown product: {" ".join(key).strip() if isinstance(key, tuple) else key}')
+            continue
+        changes[product_id] = changes.get(product_id, 0) + change
+    if changes:
+        stock = dict(db.session.query(Product.id, Product.buying_price).filter(Product.id.in_(changes)).all())
+        receive_stock([{'product_id': product_id, 'quantity': change, 'unit_cost': stock[product_id] or 0}
+                       for product_id, change in changes.items() if change > 0])
+        on_hand = dict(db.session.query(Product.id, Product.quantity)
+                       .filter(Product.id.in_([p for p, change in changes.items() if change < 0])).all())
+        for product_id, quantity in on_hand.items():
+            # Decreases stop at zero stock
+            write_off_stock(product_id, min(-changes[product_id], quantity or 0), reference='bulk adjustment')
+    update_stock_alerts(changes)
+    return len(changes), failed
+
+def parse_stock_record(record):
+    try:
+        change = int(record.get('quantity_change'))
+    except (TypeError, ValueError):
+        raise ValueError(f'invalid quantity_change: {record.get("quantity_change")!r}')
+    if record.get('product_id') not in (None, ''):
+        try:
+            return int(record['product_id']), change
+        except (TypeError, ValueError):
+            raise ValueError(f'invalid product_id: {record["product_id"]!r}')
+    if record.get('name'):
+        return (str(record['name']).strip(), str(record.get('brand') or '').strip()), change
+    raise ValueError('product_id or name is required')
+
+@app.route('/bulk_update_stock', methods=['POST'])
+def bulk_update_stock():
+    adjusted = error_count = 0
+    errors = []
+    batch = {}
+    try:
+        for row_number, record in read_import_records():
+            try:
+                if isinstance(record, ValueError):
+                    raise record
+                key, change = parse_stock_record(record)
+            except (AttributeError, ValueError) as e:
+                error_count += 1
+                import_error(errors, row_number, str(e))
+                continue
+            entry = batch.setdefault(key, [0, row_number])
+            entry[0] += change
+            if len(batch) >= IMPORT_BATCH_SIZE:
+                counts = adjust_stock_batch(batch, errors)
+                adjusted += counts[0]
+                error_count += counts[1]
+                batch = {}
+        if batch:
+            counts = adjust_stock_batch(batch, errors)
+            adjusted += counts[0]
+            error_count += counts[1]
+    except (csv.Error, UnicodeDecodeError, json.JSONDecodeError) as e:
+        db.session.rollback()
+        return jsonify({'error': f'Could not parse upload: {e}'}), 400
+    bump_cache_version('products')
+    db.session.commit()
+    return jsonify({'adjusted': adjusted, 'error_count': error_count, 'errors': errors})
+
 # ==================== SALES ====================
 
+ADD_SALE_PICKER_LIMIT = 50
+
 @app.route('/sales')
 def add_sale():
-    products = Product.query.filter(Product.quantity > 0).all()
-    customers = Customer.query.all()
-    sales = Sale.query.order_by(Sale.sale_date.desc()).limit(50).all()
-    return render_template('add_sale.html', products=products, customers=customers, sales=sales)
+    # Only a starter list is embedded; the pickers' typeahead and the JSON API reach the rest
+    products = db.session.query(Product.id, Product.name, Product.selling_price, Product.quantity) \
+        .filter(Product.quantity > 0).order_by(Product.name).limit(ADD_SALE_PICKER_LIMIT).all()
+    customers = db.session.query(Customer.id, Customer.name, Customer.phone) \
+        .order_by(Customer.created_at.desc()).limit(ADD_SALE_PICKER_LIMIT).all()
+    return render_template('add_sale.html', products=products, customers=customers)
 
 @app.route('/record_sale', methods=['POST'])
 def record_sale():
     product_id = int(request.form.get('product_id'))
     quantity = int(request.form.get('quantity'))
-    product = Product.query.get_or_404(product_id)
-    if product.quantity < quantity:
+    if quantity < 1:
+        flash('Quantity must be at least 1.', 'danger')
+        return redirect(url_for('add_sale'))
+
+    def work():
+        return create_sale_line(product_id, quantity,
+                                customer_id=request.form.get('customer_id') or None,
+                                payment_method=request.form.get('payment_method'),
+                                receipt_number=next_receipt_number(),
+                                sale_date=datetime.utcnow())
+
+    sale = run_sale_transaction(work)
+    if sale is None:
+        product = Product.query.get_or_404(product_id)
         flash(f'Not enough stock! Only {product.quantity} units available.', 'danger')
         return redirect(url_for('add_sale'))
-    total_amount = product.selling_price * quantity
-    profit = (product.selling_price - product.buying_price) * quantity
-    receipt_number = f'RCP-{datetime.now().strftime("%Y%m%d%H%M%S")}'
-    sale = Sale(
-        product_id=product_id,
-        customer_id=request.form.get('customer_id') or None,
-        quantity=quantity,
-        unit_price=product.selling_price,
-        total_amount=total_amount,
-        payment_method=request.form.get('payment_method'),
-        receipt_number=receipt_number,
-        profit=profit
-    )
-    product.quantity -= quantity
-    db.session.add(sale)
-    db.session.commit()
-    flash(f'Sale recorded! Receipt: {receipt_number}', 'success')
+    flash(f'Sale recorded! Receipt: {sale.receipt_number}', 'success')
+    return redirect(url_for('add_sale'))
+
+def checkout_basket(basket, customer_id, payment_method):
+    # basket: {product_id: quantity}. Returns (receipt number, None) or (None, first short product id)
+    shortfall = []
+
+    def work():
+        shortfall.clear()
+        receipt_number = next_receipt_number()
+        sale_date = datetime.utcnow()
+        # Lines are taken in product id order so concurrent baskets lock rows consistently
+        for line_no, (product_id, quantity) in enumerate(sorted(basket.items()), 1):
+            line_receipt = receipt_number if len(basket) == 1 else f'{receipt_number}/{line_no}'
+            if create_sale_line(product_id, quantity, customer_id, payment_method, line_receipt, sale_date) is None:
+                shortfall.append(product_id)
+                return None
+        return receipt_number
+
+    receipt_number = run_sale_transaction(work)
+    return receipt_number, shortfall[0] if shortfall else None
+
+@app.route('/checkout', methods=['POST'])
+def checkout():
+    # One basket, many lines: all stock decrements and Sale rows commit together under one receipt
+    basket = {}
+    for product_id, quantity in zip(request.form.getlist('product_id'), request.form.getlist('quantity')):
+        if product_id:
+            basket[int(product_id)] = basket.get(int(product_id), 0) + int(quantity or 0)
+    if not basket or min(basket.values()) < 1:
+        flash('Add at least one item with a quantity of 1 or more.', 'danger')
+        return redirect(url_for('add_sale'))
+    receipt_number, shortfall = checkout_basket(basket, request.form.get('customer_id') or None,
+                                                request.form.get('payment_method'))
+    if receipt_number is None:
+        product = Product.query.get_or_404(shortfall)
+        flash(f'Not enough stock for {product.name}! Only {product.quantity} units available.', 'danger')
+        return redirect(url_for('add_sale'))
+    flash(f'Sale recorded! Receipt: {receipt_number} ({len(basket)} items)', 'success')
     return redirect(url_for('add_sale'))
 
 @app.route('/sales_history')
+@read_only
+@cached('sales', 'products', 'customers')
 def sales_history():
-    sales = Sale.query.order_by(Sale.sale_date.desc()).all()
-    return render_template('sales.html', sales=sales)
+    page = paginate_sales(Sale.query, after=request.args.get('after'), before=request.args.get('before'))
+    return render_template('sales.html',
+                           sales=page['sales'],
+                           next_cursor=page['next_cursor'],
+                           prev_cursor=page['prev_cursor'])
 
 # ==================== CUSTOMERS ====================
 
+CUSTOMERS_PAGE_SIZE = 50
+
+# sort name -> (column, parser for the cursor value); every sort is descending on an indexed column
+CUSTOMER_SORTS = {
+    'recent': (Customer.created_at, datetime.fromisoformat),
+    'spend': (Customer.lifetime_spend, float),
+    'visits': (Customer.visit_count, int),
+    'last_purchase': (Customer.last_purchase_at, datetime.fromisoformat)
+}
+
+def encode_customer_cursor(value, customer_id):
+    return f'{value.isoformat() if isinstance(value, datetime) else value}_{customer_id}'
+
 @app.route('/customers')
 def customers():
-    all_customers = Customer.query.order_by(Customer.created_at.desc()).all()
-    return render_template('customers.html', customers=all_customers)
+    sort = request.args.get('sort') if request.args.get('sort') in CUSTOMER_SORTS else 'recent'
+    segment = request.args.get('segment') if request.args.get('segment') in RFM_SEGMENTS else None
+    column, parse = CUSTOMER_SORTS[sort]
+    # Keyset pagination over the aggregate columns, so no page joins or scans the Sale table
+    query = Customer.query.filter(column.isnot(None))
+    if segment:
+        query = query.filter(Customer.rfm_segment == segment)
+    after = request.args.get('after')
+    if after:
+        try:
+            value, customer_id = after.rsplit('_', 1)
+            query = query.filter(db.tuple_(column, Customer.id) < (parse(value), int(customer_id)))
+        except ValueError:
+            after = None
+    rows = query.order_by(column.desc(), Customer.id.desc()).limit(CUSTOMERS_PAGE_SIZE + 1).all()
+    page = rows[:CUSTOMERS_PAGE_SIZE]
+    next_cursor = None
+    if len(rows) > CUSTOMERS_PAGE_SIZE:
+        next_cursor = encode_customer_cursor(getattr(page[-1], column.key), page[-1].id)
+    return render_template('customers.html', customers=page, sort=sort, segment=segment,
+                           segments=RFM_SEGMENTS, next_cursor=next_cursor, paged=bool(after))
 
 @app.route('/add_customer', methods=['POST'])
 def add_customer():
@@ -207,6 +2010,7 @@ def add_customer():
         notes=request.form.get('notes')
     )
     db.session.add(customer)
+    bump_cache_version('customers')
     db.session.commit()
     flash('Customer added successfully!', 'success')
     return redirect(url_for('customers'))
@@ -214,7 +2018,10 @@ def add_customer():
 @app.route('/delete_customer/<int:id>', methods=['POST'])
 def delete_customer(id):
     customer = Customer.query.get_or_404(id)
+    CustomerCategorySpend.query.filter_by(customer_id=id).delete()
     db.session.delete(customer)
+    db.session.add(DeletedRecord(kind='customer', record_id=id))
+    bump_cache_version('customers')
     db.session.commit()
     flash('Customer deleted.', 'success')
     return redirect(url_for('customers'))
@@ -239,6 +2046,7 @@ def add_supplier():
         last_price_list=request.form.get('last_price_list')
     )
     db.session.add(supplier)
+    bump_cache_version('suppliers')
     db.session.commit()
     flash('Supplier added successfully!', 'success')
     return redirect(url_for('suppliers'))
@@ -247,25 +2055,295 @@ def add_supplier():
 def delete_supplier(id):
     supplier = Supplier.query.get_or_404(id)
     db.session.delete(supplier)
+    bump_cache_version('suppliers')
     db.session.commit()
     flash('Supplier deleted.', 'success')
     return redirect(url_for('suppliers'))
 
+# ==================== SEARCH ====================
+
+SEARCH_PAGE_SIZE = 20
+TYPEAHEAD_LIMIT = 10
+
+# kind: (rowid offset, table, title column, body columns); rowid = id * 4 + offset keeps
+# trigger deletes on the FTS rowid instead of scanning
+SEARCH_SOURCES = {
+    'product': (1, 'product', 'name', ('brand', 'category')),
+    'customer': (2, 'customer', 'name', ('phone', 'email', 'products_bought', 'skin_type', 'hair_type', 'notes')),
+    'supplier': (3, 'supplier', 'name', ('contact', 'email', 'address', 'products_supplied',
+                                         'delivery_time', 'credit_terms', 'last_price_list'))
+}
+
+def search_index_sql():
+    statements = ["CREATE VIRTUAL TABLE IF NOT EXISTS search_index USING fts5("
+                  "kind, ref_id UNINDEXED, title, body, prefix='2 3 4')"]
+    for kind, (offset, table, title, body_columns) in SEARCH_SOURCES.items():
+        def row(ref):
+            body = " || ' ' || ".join(f"coalesce({ref}.{column}, '')" for column in body_columns)
+            return f"({ref}.id * 4 + {offset}, '{kind}', {ref}.id, {ref}.{title}, {body})"
+        insert = f'INSERT INTO search_index(rowid, kind, ref_id, title, body) VALUES {row("new")};'
+        delete = f'DELETE FROM search_index WHERE rowid = old.id * 4 + {offset};'
+        columns = (title,) + body_columns
+        changed = ' OR '.join(f'old.{column} IS NOT new.{column}' for column in columns)
+        statements += [
+            f'CREATE TRIGGER IF NOT EXISTS {table}_search_insert AFTER INSERT ON {table} BEGIN {insert} END',
+            # Only text changes re-index; stock and price updates, or text written back unchanged, leave the
+            # FTS table alone
+            f'CREATE TRIGGER IF NOT EXISTS {table}_search_update AFTER UPDATE OF {", ".join(columns)} ON {table} '
+            f'WHEN {changed} BEGIN {delete} {insert} END',
+            f'CREATE TRIGGER IF NOT EXISTS {table}_search_delete AFTER DELETE ON {table} BEGIN {delete} END'
+        ]
+    return statements
+
+def search_backfill_sql():
+    statements = ['DELETE FROM search_index']
+    for kind, (offset, table, title, body_columns) in SEARCH_SOURCES.items():
+        body = " || ' ' || ".join(f"coalesce({column}, '')" for column in body_columns)
+        statements.append(f"INSERT INTO search_index(rowid, kind, ref_id, title, body) "
+                          f"SELECT id * 4 + {offset}, '{kind}', id, {title}, {body} FROM {table}")
+    return statements
+
+def full_text_search_enabled():
+    return db.engine.dialect.name == 'sqlite'
+
+def rebuild_search_index():
+    for statement in search_backfill_sql():
+        db.session.execute(db.text(statement))
+    db.session.execute(db.text("INSERT INTO search_index(search_index) VALUES ('optimize')"))
+    db.session.commit()
+
+@app.cli.command('rebuild-search-index')
+def rebuild_search_index_command():
+    """Rebuild the full-text search index from products, customers and suppliers."""
+    rebuild_search_index()
+    print('Search index rebuilt.')
+
+@on_startup
+def prepare_search_index():
+    if full_text_search_enabled():
+        created = not db.session.execute(db.text(
+            "SELECT 1 FROM sqlite_master WHERE name = 'search_index'")).first()
+        triggers = dict(db.session.execute(db.text("SELECT name, sql FROM sqlite_master WHERE type = 'trigger'")).all())
+        for statement in search_index_sql():
+            # Triggers created by an older version of this code are replaced
+            trigger = re.match(r'CREATE TRIGGER IF NOT EXISTS (\w+)', statement)
+            if trigger and triggers.get(trigger.group(1)) not in (None, statement.replace(' IF NOT EXISTS', '', 1)):
+                db.session.execute(db.text(f'DROP TRIGGER {trigger.group(1)}'))
+            db.session.execute(db.text(statement))
+        db.session.commit()
+        if created:
+            rebuild_search_index()
+
+def fts_query(q):
+    # Every word must match as a prefix of a word in the title or body
+    tokens = re.findall(r'\w+', q.lower())[:8]
+    if not tokens:
+        return None
+    return '{title body} : (' + ' AND '.join(f'"{token}"*' for token in tokens) + ')'
+
+def search(q, kind=None, limit=SEARCH_PAGE_SIZE, offset=0, ranked=True, in_stock=False):
+    # Returns [{'kind', 'id', 'title', 'snippet'}], best match first when ranked. Unranked
+    # queries stop at the first matches instead of scoring every hit, which typeahead needs.
+    # in_stock drops products without stock before the limit, so a page is never emptied afterwards
+    match = fts_query(q)
+    if match is None or kind not in (None, *SEARCH_SOURCES):
+        return []
+    if not full_text_search_enabled():
+        # Other backends fall back to a name prefix match; LIKE wildcards typed in q match literally
+        prefix = re.sub(r'([\\%_])', r'\\\1', q.strip()) + '%'
+        hits = []
+        for source_kind, model in (('product', Product), ('customer', Customer), ('supplier', Supplier)):
+            if kind in (None, source_kind):
+                query = db.session.query(model.id, model.name).filter(model.name.ilike(prefix, escape='\\'))
+                if in_stock and model is Product:
+                    query = query.filter(Product.quantity > 0)
+                rows = query.order_by(model.name).limit(limit + offset).all()
+                hits += [{'kind': source_kind, 'id': r.id, 'title': r.name, 'snippet': ''} for r in rows]
+        return hits[offset:offset + limit]
+    # The kind is filtered on the rowid rather than matched as a term, so it never widens the search
+    kind_filter = f'AND rowid % 4 = {SEARCH_SOURCES[kind][0]} ' if kind else ''
+    # A primary key probe per hit; an IN list would collect every in-stock id on each keystroke
+    stock_filter = (f"AND (rowid % 4 != {SEARCH_SOURCES['product'][0]} OR EXISTS (SELECT 1 FROM product "
+                    f"WHERE product.id = search_index.ref_id AND product.quantity > 0)) ") if in_stock else ''
+    order_by = 'ORDER BY bm25(search_index, 0.0, 0.0, 10.0, 1.0) ' if ranked else ''
+    rows = db.session.execute(db.text(
+        "SELECT kind, ref_id, title, snippet(search_index, 3, '[', ']', '...', 8) AS snippet "
+        "FROM search_index WHERE search_index MATCH :match " + kind_filter + stock_filter + order_by +
+        "LIMIT :limit OFFSET :offset"
+    ), {'match': match, 'limit': limit, 'offset': offset})
+    return [{'kind': r.kind, 'id': r.ref_id, 'title': r.title, 'snippet': r.snippet} for r in rows]
+
+@app.route('/search')
+def search_view():
+    page = max(request.args.get('page', 1, type=int), 1)
+    hits = search(request.args.get('q', ''), request.args.get('kind') or None,
+                  limit=SEARCH_PAGE_SIZE + 1, offset=(page - 1) * SEARCH_PAGE_SIZE)
+    return jsonify({'results': hits[:SEARCH_PAGE_SIZE], 'page': page,
+                    'next_page': page + 1 if len(hits) > SEARCH_PAGE_SIZE else None})
+
+@app.route('/typeahead')
+def typeahead():
+    kind = request.args.get('kind', 'product')
+    ids = [hit['id'] for hit in search(request.args.get('q', ''), kind, limit=TYPEAHEAD_LIMIT, ranked=False,
+                                       in_stock=kind == 'product')]
+    if kind == 'product':
+        rows = {r.id: r for r in db.session.query(Product.id, Product.name, Product.selling_price, Product.quantity)
+                .filter(Product.id.in_(ids), Product.quantity > 0)}
+        results = [{'id': r.id, 'name': r.name, 'price': r.selling_price, 'stock': r.quantity}
+                   for r in (rows.get(i) for i in ids) if r]
+    elif kind == 'customer':
+        rows = {r.id: r for r in db.session.query(Customer.id, Customer.name, Customer.phone)
+                .filter(Customer.id.in_(ids))}
+        results = [{'id': r.id, 'name': r.name, 'phone': r.phone} for r in (rows.get(i) for i in ids) if r]
+    else:
+        abort(400)
+    return jsonify(results)
+
+# ==================== JSON API ====================
+
+API_PAGE_SIZE = 200
+API_MAX_PAGE_SIZE = 1000
+# updated_at is stamped when a row is written but only visible once its transaction commits, so the sync
+# cursor handed out trails the clock by more than any write transaction takes; re-sent rows are harmless
+API_SYNC_OVERLAP_SECONDS = 60
+
+API_PRODUCT_FIELDS = {
+    'id': Product.id,
+    'name': Product.name,
+    'brand': Product.brand,
+    'category': Product.category,
+    'selling_price': Product.selling_price,
+    'quantity': Product.quantity,
+    'reorder_level': Product.reorder_level,
+    'expiry_date': Product.expiry_date,
+    'updated_at': Product.updated_at
+}
+API_STOCK_FIELDS = {
+    'id': Product.id,
+    'quantity': Product.quantity,
+    'reorder_level': Product.reorder_level,
+    'updated_at': Product.updated_at
+}
+API_CUSTOMER_FIELDS = {
+    'id': Customer.id,
+    'name': Customer.name,
+    'phone': Customer.phone,
+    'email': Customer.email,
+    'skin_type': Customer.skin_type,
+    'hair_type': Customer.hair_type,
+    'lifetime_spend': Customer.lifetime_spend,
+    'visit_count': Customer.visit_count,
+    'last_purchase_at': Customer.last_purchase_at,
+    'top_categories': Customer.top_categories,
+    'rfm_segment': Customer.rfm_segment,
+    'updated_at': Customer.updated_at
+}
+
+def json_value(value):
+    return value.isoformat() if isinstance(value, (datetime, date)) else value
+
+def api_list(model, available_fields, default_fields, tag, criteria=()):
+    # Keyset-paginated column tuples with ?fields=, ?after_id=, ?limit= and ?updated_since= for delta sync;
+    # a delta sync also lists the ids deleted since then. The ETag is derived from the cache version of the data, so a 304 costs one primary-key lookup.
+    version = db.session.query(CacheVersion.version).filter_by(name=tag).scalar()
+    etag = f'{request.endpoint}-{version}-{zlib.crc32(request.query_string):x}'
+    if etag in request.if_none_match:
+        return Response(status=304, headers={'ETag': f'"{etag}"'})
+
+    names = [name for name in request.args.get('fields', '').split(',') if name in available_fields] \
+        or list(default_fields)
+    if 'id' not in names:
+        names.insert(0, 'id')
+    limit = min(max(request.args.get('limit', API_PAGE_SIZE, type=int), 1), API_MAX_PAGE_SIZE)
+    query = db.session.query(*(available_fields[name] for name in names)).filter(*criteria)
+    if request.args.get('after_id', type=int):
+        query = query.filter(model.id > request.args.get('after_id', type=int))
+    updated_since = None
+    if request.args.get('updated_since'):
+        try:
+            updated_since = datetime.fromisoformat(request.args['updated_since'])
+        except ValueError:
+            return jsonify({'error': 'updated_since must be an ISO 8601 timestamp'}), 400
+        query = query.filter(model.updated_at > updated_since)
+    server_time = datetime.utcnow() - timedelta(seconds=API_SYNC_OVERLAP_SECONDS)
+    rows = query.order_by(model.id).limit(limit + 1).all()
+    items = [{name: json_value(value) for name, value in zip(names, row)} for row in rows[:limit]]
+    body = {
+        'items': items,
+        'next_after_id': items[-1]['id'] if len(rows) > limit else None,
+        'server_time': server_time.isoformat()
+    }
+    if updated_since is not None:
+        body['deleted'] = [record_id for (record_id,) in db.session.query(DeletedRecord.record_id).filter(
+            DeletedRecord.kind == model.__tablename__, DeletedRecord.deleted_at > updated_since)
+            .order_by(DeletedRecord.record_id).distinct()]
+    response = jsonify(body)
+    response.set_etag(etag)
+    return response
+
+@app.route('/api/products')
+def api_products():
+    criteria = [Product.quantity > 0] if request.args.get('in_stock') == '1' else []
+    return api_list(Product, API_PRODUCT_FIELDS,
+                    ('id', 'name', 'brand', 'category', 'selling_price', 'quantity'), 'products', criteria)
+
+@app.route('/api/stock')
+def api_stock():
+    criteria = []
+    if request.args.get('ids'):
+        try:
+            criteria.append(Product.id.in_([int(i) for i in request.args['ids'].split(',')]))
+        except ValueError:
+            return jsonify({'error': 'ids must be a comma-separated list of product ids'}), 400
+    return api_list(Product, API_STOCK_FIELDS, ('id', 'quantity'), 'products', criteria)
+
+@app.route('/api/customers')
+def api_customers():
+    return api_list(Customer, API_CUSTOMER_FIELDS, ('id', 'name', 'phone'), 'customers')
+
+@app.route('/api/sales', methods=['POST'])
+def api_record_sale():
+    payload = request.get_json(silent=True)
+    if not isinstance(payload, dict) or not isinstance(payload.get('lines'), list):
+        return jsonify({'error': 'expected a JSON object with a list of lines'}), 400
+    if not isinstance(payload.get('payment_method'), (str, type(None))):
+        return jsonify({'error': 'payment_method must be a string'}), 400
+    basket = {}
+    try:
+        for line in payload['lines']:
+            basket[int(line['product_id'])] = basket.get(int(line['product_id']), 0) + int(line['quantity'])
+        customer_id = int(payload['customer_id']) if payload.get('customer_id') else None
+    except (KeyError, TypeError, ValueError):
+        return jsonify({'error': 'lines must be a list of {product_id, quantity}'}), 400
+    if not basket or min(basket.values()) < 1:
+        return jsonify({'error': 'at least one line with a quantity of 1 or more is required'}), 400
+    receipt_number, shortfall = checkout_basket(basket, customer_id, payment_method=payload.get('payment_method'))
+    if receipt_number is None:
+        available = db.session.query(Product.quantity).filter_by(id=shortfall).scalar()
+        if available is None:
+            return jsonify({'error': 'unknown product', 'product_id': shortfall}), 404
+        return jsonify({'error': 'not enough stock', 'product_id': shortfall, 'available': available}), 409
+    total = db.session.query(db.func.sum(Sale.total_amount)).filter(db.or_(
+        Sale.receipt_number == receipt_number,
+        Sale.receipt_number.between(f'{receipt_number}/', f'{receipt_number}/~'))).scalar()
+    return jsonify({'receipt_number': receipt_number, 'lines': len(basket), 'total_amount': total}), 201
+
 # ==================== FINANCE ====================
 
 @app.route('/finance')
+@read_only
+@cached('sales', 'expenses')
+@in_report_pool
 def finance():
     expenses = Expense.query.order_by(Expense.date.desc()).all()
-    total_expenses = sum(e.amount for e in expenses)
-    all_sales = Sale.query.all()
-    total_revenue = sum(s.total_amount for s in all_sales)
-    total_profit = sum(s.profit for s in all_sales)
-    net_profit = total_profit - total_expenses
+    total_expenses = expense_total()
+    totals = sales_totals()
+    net_profit = totals['profit'] - total_expenses
     return render_template('finance.html',
                            expenses=expenses,
                            total_expenses=total_expenses,
-                           total_revenue=total_revenue,
-                           total_profit=total_profit,
+                           total_revenue=totals['revenue'],
+                           total_profit=totals['profit'],
                            net_profit=net_profit)
 
 @app.route('/add_expense', methods=['POST'])
@@ -277,6 +2355,7 @@ def add_expense():
         amount=float(request.form.get('amount', 0))
     )
     db.session.add(expense)
+    bump_cache_version('expenses')
     db.session.commit()
     flash('Expense recorded successfully!', 'success')
     return redirect(url_for('finance'))
@@ -285,6 +2364,7 @@ def add_expense():
 def delete_expense(id):
     expense = Expense.query.get_or_404(id)
     db.session.delete(expense)
+    bump_cache_version('expenses')
     db.session.commit()
     flash('Expense deleted.', 'success')
     return redirect(url_for('finance'))
@@ -292,92 +2372,342 @@ def delete_expense(id):
 # ==================== REPORTS ====================
 
 @app.route('/reports')
+@read_only
+@cached('sales', 'products', 'customers', 'expenses')
+@in_report_pool
 def reports():
     start_date = request.args.get('start_date')
     end_date = request.args.get('end_date')
+    start_day, end_day = report_date_range()
+    criteria = sale_date_criteria(start_day, end_day)
 
-    query = Sale.query
-    if start_date:
-        query = query.filter(Sale.sale_date >= datetime.strptime(start_date, '%Y-%m-%d'))
-    if end_date:
-        query = query.filter(Sale.sale_date <= datetime.strptime(end_date, '%Y-%m-%d').replace(hour=23, minute=59))
+    totals = sales_totals(start_day, end_day)
+    total_expenses = expense_total()
+    payment_breakdown = sales_by_payment_method(start_day, end_day)
 
-    sales = query.order_by(Sale.sale_date.desc()).all()
-    total_revenue = sum(s.total_amount for s in sales)
-    total_profit = sum(s.profit for s in sales)
-    total_quantity = sum(s.quantity for s in sales)
-    total_expenses = sum(e.amount for e in Expense.query.all())
-
-    # Top products: list of dicts for easy template access
-    top_product_rows = db.session.query(
-        Product.name,
-        Product.category,
-        db.func.sum(Sale.quantity).label('total_sold')
-    ).join(Sale).group_by(Product.id).order_by(db.func.sum(Sale.quantity).desc()).limit(5).all()
-
-    top_products = [{'name': r.name, 'category': r.category, 'quantity': r.total_sold} for r in top_product_rows]
-
-    # Payment breakdown
-    payment_breakdown = {}
-    for sale in sales:
-        method = sale.payment_method or 'unknown'
-        payment_breakdown[method] = payment_breakdown.get(method, 0) + sale.total_amount
+    page = paginate_sales(Sale.query.filter(*criteria),
+                          after=request.args.get('after'), before=request.args.get('before'))
+    # Archived sales are in the totals (from the daily rollup) but not in the live listing
+    boundary = archived_until()
+    archived_sales = 0
+    if boundary and (not start_day or start_day < boundary):
+        archived_sales = sales_totals(start_day, min(end_day or boundary, boundary - timedelta(days=1)))['count']
 
     return render_template('reports.html',
-                           sales=sales,
-                           total_revenue=total_revenue,
-                           total_profit=total_profit,
-                           total_quantity=total_quantity,
+                           sales=page['sales'],
+                           sales_count=totals['count'],
+                           archived_sales=archived_sales,
+                           archived_until=boundary,
+                           next_cursor=page['next_cursor'],
+                           prev_cursor=page['prev_cursor'],
+                           total_revenue=totals['revenue'],
+                           total_profit=totals['profit'],
+                           total_quantity=totals['quantity'],
                            total_expenses=total_expenses,
-                           top_products=top_products,
+                           top_products=top_products(),
                            payment_breakdown=payment_breakdown,
                            start_date=start_date,
                            end_date=end_date)
 
+# ==================== EXPORTS ====================
+
+EXPORT_BATCH_SIZE = 1000
+
+def stream_csv(header, rows, batch_size=EXPORT_BATCH_SIZE):
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(header)
+    # Send the header straight away, then flush rows in batches
+    yield buffer.getvalue()
+    buffer.seek(0)
+    buffer.truncate(0)
+    for i, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if i % batch_size == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate(0)
+    yield buffer.getvalue()
+
+def csv_export(filename, header, statement, archived_rows=()):
+    # yield_per streams column tuples from a server-side cursor instead of building ORM objects;
+    # rows from the archive files, being older, go first
+    rows = chain(archived_rows, db.session.execute(statement.execution_options(yield_per=EXPORT_BATCH_SIZE)))
+    return Response(stream_with_context(stream_csv(header, rows)),
+                    mimetype='text/csv',
+                    headers={'Content-Disposition': f'attachment; filename={filename}'})
+
+def sales_ledger_statement(start_day=None, end_day=None):
+    return db.select(
+        Sale.receipt_number, Sale.sale_date, Product.name, Product.category, Customer.name,
+        Sale.quantity, Sale.unit_price, Sale.total_amount, Sale.profit, Sale.payment_method
+    ).outerjoin(Product, Sale.product_id == Product.id).outerjoin(Customer, Sale.customer_id == Customer.id) \
+        .filter(*sale_date_criteria(start_day, end_day)).order_by(Sale.sale_date, Sale.id)
+
+@app.route('/export/sales')
+@read_only
+def export_sales():
+    return csv_export('sales.csv',
+                      ['Receipt', 'Date', 'Product', 'Category', 'Customer', 'Quantity',
+                       'Unit Price', 'Total', 'Profit', 'Payment Method'],
+                      sales_ledger_statement(*report_date_range()), archived_sales_rows(*report_date_range()))
+
+@app.route('/export/expenses')
+@read_only
+def export_expenses():
+    start_day, end_day = report_date_range()
+    statement = db.select(Expense.date, Expense.category, Expense.description, Expense.amount)
+    if start_day:
+        statement = statement.filter(Expense.date >= start_day)
+    if end_day:
+        statement = statement.filter(Expense.date <= end_day)
+    return csv_export('expenses.csv', ['Date', 'Category', 'Description', 'Amount'],
+                      statement.order_by(Expense.date, Expense.id), archived_expense_rows(start_day, end_day))
+
+@app.route('/export/products')
+@read_only
+def export_products():
+    statement = db.select(
+        Product.id, Product.name, Product.brand, Product.category, Product.buying_price,
+        Product.selling_price, Product.quantity, Product.reorder_level, Supplier.name, Product.expiry_date
+    ).outerjoin(Supplier, Product.supplier_id == Supplier.id).order_by(Product.id)
+    return csv_export('products.csv',
+                      ['ID', 'Name', 'Brand', 'Category', 'Buying Price', 'Selling Price',
+                       'Quantity', 'Reorder Level', 'Supplier', 'Expiry Date'],
+                      statement)
+
 # ==================== WEEKLY REPORTS ====================
 
-@app.route('/weekly_reports')
-def weekly_reports():
+def current_week():
     today = datetime.now().date()
     start_of_week = today - timedelta(days=today.weekday())
-    end_of_week = start_of_week + timedelta(days=6)
+    return start_of_week, start_of_week + timedelta(days=6)
 
-    week_sales = Sale.query.filter(
-        db.func.date(Sale.sale_date) >= start_of_week,
-        db.func.date(Sale.sale_date) <= end_of_week
-    ).all()
+@app.route('/weekly_reports')
+@read_only
+@cached('sales')
+@in_report_pool
+def weekly_reports():
+    start_of_week, end_of_week = current_week()
 
-    total_revenue = sum(s.total_amount for s in week_sales)
-    total_profit = sum(s.profit for s in week_sales)
-    total_quantity = sum(s.quantity for s in week_sales)
+    totals = sales_totals(start_of_week, end_of_week)
 
     # Daily breakdown
-    daily_sales = {}
-    for i in range(7):
-        day = start_of_week + timedelta(days=i)
-        day_str = day.strftime('%A %d %b')
-        day_sales = [s for s in week_sales if s.sale_date.date() == day]
-        daily_sales[day_str] = {
-            'revenue': sum(s.total_amount for s in day_sales),
-            'profit': sum(s.profit for s in day_sales),
-            'quantity': sum(s.quantity for s in day_sales)
-        }
+    daily_sales = {day.strftime('%A %d %b'): data
+                   for day, data in sales_by_day(start_of_week, end_of_week).items()}
 
     # Category breakdown
-    category_sales = {}
-    for sale in week_sales:
-        cat = sale.product.category or 'Other'
-        category_sales[cat] = category_sales.get(cat, 0) + sale.total_amount
+    category_sales = sales_by_category(start_of_week, end_of_week)
 
     return render_template('weekly_reports.html',
                            start_of_week=start_of_week,
                            end_of_week=end_of_week,
-                           total_revenue=total_revenue,
-                           total_profit=total_profit,
-                           total_quantity=total_quantity,
+                           total_revenue=totals['revenue'],
+                           total_profit=totals['profit'],
+                           total_quantity=totals['quantity'],
                            daily_sales=daily_sales,
                            category_sales=category_sales)
 
+# ==================== PDF DOCUMENTS ====================
+
+PDF_MARGIN = 15 * mm
+PDF_ROW_HEIGHT = 14
+# Finished PDFs stay in memory up to this size, then spill to a temporary file
+PDF_SPOOL_SIZE = 4 * 1024 * 1024
+
+@lru_cache(maxsize=None)
+def pdf_fonts():
+    # Loaded once per worker; the built-in Helvetica needs no embedding
+    font_path = os.environ.get('PDF_FONT_PATH')
+    if font_path:
+        pdfmetrics.registerFont(TTFont('ShopFont', font_path))
+        return 'ShopFont', 'ShopFont'
+    return 'Helvetica', 'Helvetica-Bold'
+
+@lru_cache(maxsize=None)
+def pdf_column_positions(columns, usable_width):
+    positions = []
+    x = PDF_MARGIN
+    for heading, share, align in columns:
+        width = usable_width * share
+        positions.append((x, width, align))
+        x += width
+    return tuple(positions)
+
+class PdfDocument:
+    # Draws rows straight onto the canvas and closes each page as it fills, so no flowable
+    # list for the whole report is ever built
+    def __init__(self, output, title, subtitle=''):
+        self.canvas = canvas.Canvas(output, pagesize=A4, pageCompression=1)
+        self.canvas.setTitle(title)
+        self.font, self.bold_font = pdf_fonts()
+        self.title = title
+        self.subtitle = subtitle
+        self.width, self.height = A4
+        self.page_number = 0
+        self.columns = None
+        self.new_page()
+
+    def new_page(self):
+        if self.page_number:
+            self.canvas.showPage()
+        self.page_number += 1
+        self.canvas.setFont(self.bold_font, 14)
+        self.canvas.drawString(PDF_MARGIN, self.height - PDF_MARGIN, self.title)
+        self.canvas.setFont(self.font, 9)
+        self.canvas.drawString(PDF_MARGIN, self.height - PDF_MARGIN - 14, self.subtitle)
+        self.canvas.drawRightString(self.width - PDF_MARGIN, PDF_MARGIN / 2, f'Page {self.page_number}')
+        self.y = self.height - PDF_MARGIN - 36
+        if self.columns:
+            self.draw_table_header()
+
+    def ensure_space(self, height=PDF_ROW_HEIGHT):
+        if self.y - height < PDF_MARGIN:
+            self.new_page()
+
+    def heading(self, text):
+        self.columns = None
+        self.ensure_space(PDF_ROW_HEIGHT * 3)
+        self.y -= 8
+        self.canvas.setFont(self.bold_font, 11)
+        self.canvas.drawString(PDF_MARGIN, self.y, text)
+        self.y -= PDF_ROW_HEIGHT
+
+    def field(self, label, value):
+        self.ensure_space()
+        self.canvas.setFont(self.bold_font, 9)
+        self.canvas.drawString(PDF_MARGIN, self.y, label)
+        self.canvas.setFont(self.font, 9)
+        self.canvas.drawString(PDF_MARGIN + 45 * mm, self.y, str(value))
+        self.y -= PDF_ROW_HEIGHT
+
+    def start_table(self, columns):
+        # columns: tuple of (heading, share of page width, 'left' or 'right')
+        self.columns = tuple(columns)
+        self.ensure_space(PDF_ROW_HEIGHT * 2)
+        self.draw_table_header()
+
+    def draw_table_header(self):
+        self.draw_cells([heading for heading, share, align in self.columns], self.bold_font)
+        self.canvas.line(PDF_MARGIN, self.y + PDF_ROW_HEIGHT - 3, self.width - PDF_MARGIN, self.y + PDF_ROW_HEIGHT - 3)
+
+    def row(self, values):
+        self.ensure_space()
+        self.draw_cells(values, self.font)
+
+    def draw_cells(self, values, font):
+        self.canvas.setFont(font, 8)
+        for (x, width, align), value in zip(pdf_column_positions(self.columns, self.width - 2 * PDF_MARGIN), values):
+            text = '' if value is None else str(value)
+            while text and pdfmetrics.stringWidth(text, font, 8) > width - 8:
+                text = text[:-1]
+            if align == 'right':
+                self.canvas.drawRightString(x + width - 8, self.y, text)
+            else:
+                self.canvas.drawString(x, self.y, text)
+        self.y -= PDF_ROW_HEIGHT
+
+    def save(self):
+        self.canvas.save()
+
+def money(value):
+    return f'KES {value or 0:,.0f}'
+
+def pdf_response(filename, build):
+    output = tempfile.SpooledTemporaryFile(max_size=PDF_SPOOL_SIZE)
+    build(output)
+    output.seek(0)
+    return send_file(output, mimetype='application/pdf', download_name=filename)
+
+@app.route('/receipt/<receipt_number>.pdf')
+def receipt_pdf(receipt_number):
+    lines = receipt_lines(receipt_number)
+    if not lines:
+        abort(404)
+
+    def build(output):
+        first = lines[0]
+        document = PdfDocument(output, 'Cosmetic Shop - Receipt',
+                               f'{receipt_number}   {first.sale_date.strftime("%Y-%m-%d %H:%M")}')
+        document.field('Customer', first.customer.name if first.customer else 'Walk-in')
+        document.field('Payment', first.payment_method or '-')
+        document.start_table((('Product', 0.55, 'left'), ('Qty', 0.1, 'right'),
+                              ('Unit Price', 0.175, 'right'), ('Total', 0.175, 'right')))
+        for sale in lines:
+            document.row((sale.product.name if sale.product else '-', sale.quantity,
+                          money(sale.unit_price), money(sale.total_amount)))
+        document.heading('Total')
+        document.field('Items', sum(sale.quantity for sale in lines))
+        document.field('Amount', money(sum(sale.total_amount for sale in lines)))
+        document.save()
+
+    return pdf_response(f'{receipt_number}.pdf', build)
+
+@app.route('/reports/pdf')
+@read_only
+@in_report_pool
+def reports_pdf():
+    start_day, end_day = report_date_range()
+    totals = sales_totals(start_day, end_day)
+    payment_breakdown = sales_by_payment_method(start_day, end_day)
+    best_sellers = top_products()
+
+    def build(output):
+        document = PdfDocument(output, 'Cosmetic Shop - Sales Report',
+                               f'{start_day or "All time"} to {end_day or "today"}')
+        document.field('Total Revenue', money(totals['revenue']))
+        document.field('Total Profit', money(totals['profit']))
+        document.field('Total Items Sold', totals['quantity'])
+        document.field('Number of Sales', totals['count'])
+        document.field('Total Expenses', money(expense_total()))
+        document.heading('Payment Method Breakdown')
+        document.start_table((('Payment Method', 0.5, 'left'), ('Total Amount', 0.5, 'right')))
+        for method, amount in payment_breakdown.items():
+            document.row((method.capitalize(), money(amount)))
+        document.heading('Top Selling Products')
+        document.start_table((('Product', 0.5, 'left'), ('Category', 0.3, 'left'), ('Quantity Sold', 0.2, 'right')))
+        for item in best_sellers:
+            document.row((item['name'], item['category'] or '-', item['quantity']))
+        document.heading('All Sales')
+        document.start_table((('Receipt #', 0.18, 'left'), ('Date', 0.1, 'left'), ('Product', 0.22, 'left'),
+                              ('Customer', 0.16, 'left'), ('Qty', 0.06, 'right'), ('Total', 0.1, 'right'),
+                              ('Profit', 0.1, 'right'), ('Payment', 0.08, 'left')))
+        rows = chain(archived_sales_rows(start_day, end_day),
+                     db.session.execute(sales_ledger_statement(start_day, end_day)
+                                        .execution_options(yield_per=EXPORT_BATCH_SIZE)))
+        for receipt, sale_date, product, category, customer, quantity, unit_price, total, profit, method in rows:
+            document.row((receipt, sale_date.strftime('%Y-%m-%d'), product, customer or 'Walk-in',
+                          quantity, money(total), money(profit), method or '-'))
+        document.save()
+
+    return pdf_response('sales_report.pdf', build)
+
+@app.route('/weekly_reports/pdf')
+@read_only
+@in_report_pool
+def weekly_reports_pdf():
+    start_of_week, end_of_week = current_week()
+    totals = sales_totals(start_of_week, end_of_week)
+
+    def build(output):
+        document = PdfDocument(output, 'Cosmetic Shop - Weekly Report', f'Week: {start_of_week} to {end_of_week}')
+        document.field('Weekly Revenue', money(totals['revenue']))
+        document.field('Weekly Profit', money(totals['profit']))
+        document.field('Items Sold', totals['quantity'])
+        document.heading('Daily Sales Breakdown')
+        document.start_table((('Day', 0.4, 'left'), ('Revenue', 0.2, 'right'),
+                              ('Profit', 0.2, 'right'), ('Items Sold', 0.2, 'right')))
+        for day, data in sales_by_day(start_of_week, end_of_week).items():
+            document.row((day.strftime('%A %d %b'), money(data['revenue']), money(data['profit']), data['quantity']))
+        document.heading('Sales by Category')
+        document.start_table((('Category', 0.5, 'left'), ('Total Sales', 0.5, 'right')))
+        for category, amount in sales_by_category(start_of_week, end_of_week).items():
+            document.row((category, money(amount)))
+        document.save()
+
+    return pdf_response('weekly_report.pdf', build)
+
 # ==================== MAIN ====================
+# Development server only; production runs under gunicorn with gunicorn.conf.py (gunicorn app:app)
 if __name__ == '__main__':
     app.run(host='0.0.0.0', port=int(os.environ.get('PORT', 5000)), debug=True)
@@ -0,0 +1,321 @@
+import argparse
+import contextvars
+import csv
+import io
+import json
+import math
+import os
+import random
+import resource
+import sqlite3
+import sys
+import tempfile
+import threading
+import time
+import tracemalloc
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from datetime import date, timedelta
+
+# Drives every GET route of app.py (and with --writes its POST routes) through the Flask test client against
+# DATABASE_URL and reports latency, queries per request and memory. Without DATABASE_URL it runs on a scratch copy
+# of instance/inventory.db, so the committed database is never written to. Load a realistic database first, e.g.
+#   DATABASE_URL=sqlite:////tmp/bench.db python sample_data.py --products 10000 --customers 500000 --sales 10000000
+#   DATABASE_URL=sqlite:////tmp/bench.db python benchmark.py --save-baseline
+#   DATABASE_URL=sqlite:////tmp/bench.db python benchmark.py --concurrency 8 --duration 30 --writes
+parser = argparse.ArgumentParser(description='Benchmark the shop routes.')
+parser.add_argument('--requests', type=int, default=20, help='timed requests per route in sequential mode')
+parser.add_argument('--max-seconds', type=float, default=15, help='stop timing a route early after this many seconds')
+parser.add_argument('--concurrency', type=int, default=0, help='threads for the concurrent load mode (0 = sequential)')
+parser.add_argument('--duration', type=float, default=20, help='seconds to run the concurrent load mode')
+parser.add_argument('--writes', action='store_true',
+                    help='mix the POST routes (sales, stock, imports, adds and deletes) into the load')
+parser.add_argument('--cache', action='store_true', help='leave the response cache on (off by default)')
+parser.add_argument('--routes', help='only run scenarios whose name contains this text')
+parser.add_argument('--baseline', help='baseline results to compare against (default: instance/benchmark_baseline.json)')
+parser.add_argument('--save-baseline', action='store_true', help='store this run as the new baseline')
+parser.add_argument('--tolerance', type=float, default=0.25, help='allowed p50 slowdown before flagging (0.25 = 25%%)')
+args = parser.parse_args()
+
+if not os.environ.get('DATABASE_URL'):
+    scratch = os.path.join(tempfile.mkdtemp(), 'bench.db')
+    source = os.path.join(os.path.dirname(os.path.abspath(__file__)), 'instance', 'inventory.db')
+    if os.path.exists(source):
+        with sqlite3.connect(source) as committed, sqlite3.connect(scratch) as copy:
+            committed.backup(copy)
+    os.environ['DATABASE_URL'] = f'sqlite:///{scratch}'
+    print(f'DATABASE_URL not set, running on a scratch copy: {scratch}', file=sys.stderr)
+os.environ['CACHE_ENABLED'] = '1' if args.cache else '0'
+os.environ['BACKGROUND_JOBS'] = '0'
+os.environ['PROFILING'] = '0'
+
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from app import app, db, Product, Customer, Supplier, Sale, Expense, encode_sale_cursor
+
+# Stock and last sale id of the products the write scenarios sell, taken before the run
+write_check = {}
+
+baseline_path = args.baseline or os.path.join(app.instance_path, 'benchmark_baseline.json')
+
+# A context variable rather than a thread-local, so queries that report routes run in app.report_pool still count
+query_counter = contextvars.ContextVar('query_counter')
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def count_query(conn, cursor, statement, parameters, context, executemany):
+    counter = query_counter.get(None)
+    if counter is not None:
+        counter[0] += 1
+
+def percentile(values, fraction):
+    # Nearest-rank percentile
+    ordered = sorted(values)
+    return ordered[max(0, math.ceil(fraction * len(ordered)) - 1)]
+
+def build_scenarios():
+    with app.app_context():
+        product = db.session.query(Product.id, Product.name).order_by(Product.id).first()
+        customer = db.session.query(Customer.name).order_by(Customer.id).first()
+        sale = db.session.query(Sale).order_by(Sale.sale_date.desc(), Sale.id.desc()).offset(200).first() \
+            or Sale.query.first()
+        first_sale_date = db.session.query(db.func.min(Sale.sale_date)).scalar()
+    word = product.name.split()[0] if product else 'lotion'
+    # Values for URL parameters (extra ones become the query string); routes with path parameters not listed
+    # here are skipped
+    url_values = {
+        'update_stock': {'id': product.id if product else 1},
+        # Basket lines are numbered RCP-.../2; the PDF is per receipt
+        'receipt_pdf': {'receipt_number': sale.receipt_number.split('/')[0] if sale else 'none'},
+        'search_view': {'q': word},
+        'typeahead': {'q': word[:3]}
+    }
+    scenarios = {}
+    with app.test_request_context():
+        for rule in sorted(app.url_map.iter_rules(), key=lambda rule: rule.rule):
+            if 'GET' not in rule.methods or rule.endpoint in ('static', 'metrics'):
+                continue
+            if rule.arguments and rule.endpoint not in url_values:
+                print(f'skipping {rule.rule}: no sample values for {sorted(rule.arguments)}')
+                continue
+            scenarios[rule.endpoint] = ('GET', app.url_for(rule.endpoint, **url_values.get(rule.endpoint, {})), None)
+    # Full-ledger exports grow with the Sale table, so by default they cover the last 30 days;
+    # the *_all_time variants can be picked with --routes
+    month = f'start_date={date.today() - timedelta(days=30):%Y-%m-%d}&end_date={date.today():%Y-%m-%d}'
+    for endpoint in ('export_sales', 'reports_pdf'):
+        if endpoint in scenarios:
+            scenarios[endpoint] = ('GET', f'{scenarios[endpoint][1]}?{month}', None)
+    scenarios.update({
+        'export_sales_all_time': ('GET', '/export/sales', None),
+        'reports_pdf_all_time': ('GET', '/reports/pdf', None),
+        'reports_all_time': ('GET', f'/reports?start_date={first_sale_date:%Y-%m-%d}'
+                                    f'&end_date={date.today():%Y-%m-%d}', None) if first_sale_date else None,
+        'sales_history_page_5': ('GET', f'/sales_history?after={encode_sale_cursor(sale)}', None) if sale else None,
+        'search_products': ('GET', f'/search?q={word}&kind=product', None),
+        'typeahead_product': ('GET', f'/typeahead?kind=product&q={word[:3]}', None),
+        'typeahead_customer': ('GET', f'/typeahead?kind=customer&q={customer.name[:3] if customer else "gra"}', None),
+        'api_products_page': ('GET', '/api/products?limit=1000', None)
+    })
+    if args.writes:
+        scenarios.update(build_write_scenarios())
+    return {name: s for name, s in scenarios.items() if s and (args.routes in name if args.routes
+                                                                 else not name.endswith('_all_time'))}
+
+def build_write_scenarios():
+    # Sales draw on one set of products and stock receipts/imports touch another, so check_stock() can
+    # compare the units sold with the stock decrement
+    with app.app_context():
+        candidates = [product_id for (product_id,) in
+                      db.session.query(Product.id).filter(Product.quantity > 0).order_by(Product.id).limit(70)]
+        # Up to 50 products are sold; small databases are split in half so some are left to restock
+        in_stock = candidates[:max(len(candidates) - 20, (len(candidates) + 1) // 2)]
+        restocked = db.session.query(Product.id, Product.name, Product.brand, Product.selling_price) \
+            .filter(Product.id.notin_(in_stock)).order_by(Product.id).limit(20).all()
+        write_check.update(
+            product_ids=in_stock,
+            stock=db.session.query(db.func.coalesce(db.func.sum(Product.quantity), 0))
+            .filter(Product.id.in_(in_stock)).scalar(),
+            last_sale_id=db.session.query(db.func.coalesce(db.func.max(Sale.id), 0)).scalar())
+    if not in_stock or not restocked:
+        print('skipping write scenarios: not enough products')
+        return {}
+
+    def upload(filename, header, rows):
+        buffer = io.StringIO()
+        writer = csv.writer(buffer)
+        writer.writerow(header)
+        writer.writerows(rows)
+        return lambda: {'data': {'file': (io.BytesIO(buffer.getvalue().encode()), filename)},
+                        'content_type': 'multipart/form-data'}
+
+    def deletable(route, model, **values):
+        # Each delete gets a row of its own, created before the request is timed
+        def url():
+            with app.app_context():
+                row = model(**values)
+                db.session.add(row)
+                db.session.commit()
+                return f'/{route}/{row.id}'
+        return url
+
+    added = {'name': 'Benchmark', 'brand': 'Benchmark', 'category': 'makeup'}
+    return {
+        'add_product': ('POST', '/add_product', lambda: {'data': {
+            **added, 'buying_price': 100, 'selling_price': 150, 'quantity': 5, 'reorder_level': 2}}),
+        'add_customer': ('POST', '/add_customer', lambda: {'data': {'name': 'Benchmark', 'phone': '0700000000'}}),
+        'add_supplier': ('POST', '/add_supplier', lambda: {'data': {'name': 'Benchmark', 'delivery_time': '3 days'}}),
+        'add_expense': ('POST', '/add_expense', lambda: {'data': {
+            'date': f'{date.today():%Y-%m-%d}', 'category': 'other', 'description': 'Benchmark', 'amount': 1}}),
+        'delete_product': ('POST', deletable('delete_product', Product, **added, quantity=0), None),
+        'delete_customer': ('POST', deletable('delete_customer', Customer, name='Benchmark'), None),
+        'delete_supplier': ('POST', deletable('delete_supplier', Supplier, name='Benchmark'), None),
+        'delete_expense': ('POST', deletable('delete_expense', Expense, date=date.today(), category='other',
+                                             amount=1), None),
+        'api_sale': ('POST', '/api/sales', lambda: {'json': {
+            'lines': [{'product_id': random.choice(in_stock), 'quantity': 1}], 'payment_method': 'cash'}}),
+        'record_sale': ('POST', '/record_sale', lambda: {'data': {
+            'product_id': random.choice(in_stock), 'quantity': 1, 'payment_method': 'cash'}}),
+        'checkout': ('POST', '/checkout', lambda: {'data': {
+            'product_id': random.sample(in_stock, min(2, len(in_stock))), 'quantity': [1, 1],
+            'payment_method': 'mpesa'}}),
+        'update_stock_post': ('POST', f'/update_stock/{restocked[0].id}', lambda: {'data': {'quantity_change': 1}}),
+        'import_products': ('POST', '/import_products', upload(
+            'prices.csv', ['name', 'brand', 'selling_price'],
+            [(p.name, p.brand or '', p.selling_price) for p in restocked])),
+        'bulk_update_stock': ('POST', '/bulk_update_stock', upload(
+            'stock.csv', ['product_id', 'quantity_change'], [(p.id, 1) for p in restocked]))
+    }
+
+def send(client, scenario):
+    method, url, body = scenario
+    url = url() if callable(url) else url
+    payload = body() if body else {}
+    counter = [0]
+    query_counter.set(counter)
+    started = time.perf_counter()
+    if method == 'POST':
+        response = client.post(url, **payload)
+    else:
+        response = client.get(url)
+    # Streamed responses (CSV exports) only do their work while the body is read
+    response.get_data()
+    elapsed = time.perf_counter() - started
+    return elapsed, counter[0], response.status_code
+
+def run_sequential(scenarios):
+    client = app.test_client()
+    results = {}
+    for name, scenario in scenarios.items():
+        print(f'{name}...', file=sys.stderr, flush=True)
+        # tracemalloc slows Python code several times over, so memory is taken from a separate warm-up request
+        tracemalloc.start()
+        send(client, scenario)
+        peak_memory = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        timings, queries, errors = [], [], 0
+        deadline = time.monotonic() + args.max_seconds
+        for _ in range(args.requests):
+            if timings and time.monotonic() > deadline:
+                break
+            elapsed, count, status = send(client, scenario)
+            timings.append(elapsed)
+            queries.append(count)
+            errors += not 200 <= status < 400
+        results[name] = summarize(timings, queries, errors, peak_memory=peak_memory)
+    return results
+
+def run_concurrent(scenarios):
+    names = list(scenarios)
+    samples = defaultdict(list)
+    lock = threading.Lock()
+    deadline = time.monotonic() + args.duration
+
+    def worker():
+        client = app.test_client()
+        local = []
+        while time.monotonic() < deadline:
+            name = random.choice(names)
+            local.append((name,) + send(client, scenarios[name]))
+        with lock:
+            for name, elapsed, count, status in local:
+                samples[name].append((elapsed, count, status))
+
+    started = time.perf_counter()
+    with ThreadPoolExecutor(args.concurrency) as pool:
+        for future in [pool.submit(worker) for _ in range(args.concurrency)]:
+            future.result()
+    wall = time.perf_counter() - started
+    total = sum(len(s) for s in samples.values())
+    print(f'{total} requests in {wall:.1f}s with {args.concurrency} threads: {total / wall:.1f} req/s')
+    return {name: summarize([s[0] for s in rows], [s[1] for s in rows], sum(not 200 <= s[2] < 400 for s in rows))
+            for name, rows in sorted(samples.items())}
+
+def summarize(timings, queries, errors, peak_memory=None):
+    return {
+        'requests': len(timings),
+        'p50_ms': round(percentile(timings, 0.5) * 1000, 2),
+        'p99_ms': round(percentile(timings, 0.99) * 1000, 2),
+        'queries': round(sum(queries) / len(queries), 1),
+        'peak_kb': round(peak_memory / 1024) if peak_memory is not None else None,
+        'errors': errors
+    }
+
+def report(results, baseline):
+    regressions = []
+    print(f'{"route":<28}{"n":>6}{"p50 ms":>10}{"p99 ms":>10}{"queries":>9}{"peak KB":>9}{"errors":>7}  vs baseline')
+    for name, r in results.items():
+        note = ''
+        before = baseline.get(name)
+        if before:
+            change = (r['p50_ms'] - before['p50_ms']) / before['p50_ms'] if before['p50_ms'] else 0
+            note = f'p50 {change:+.0%}'
+            # Sub-millisecond jitter is ignored; more queries per request is always worth a look
+            if change > args.tolerance and r['p50_ms'] - before['p50_ms'] > 1:
+                regressions.append(name)
+                note += ' SLOWER'
+            if r['queries'] > before['queries']:
+                regressions.append(name)
+                note += f' queries {before["queries"]} -> {r["queries"]}'
+        peak = r['peak_kb'] if r['peak_kb'] is not None else '-'
+        print(f'{name:<28}{r["requests"]:>6}{r["p50_ms"]:>10}{r["p99_ms"]:>10}{r["queries"]:>9}{peak:>9}'
+              f'{r["errors"]:>7}  {note}')
+    print(f'max RSS: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss // 1024} MB')
+    return regressions
+
+def check_stock():
+    # Every unit sold during the run must have come off the stock of the products sold, and no more
+    if not write_check:
+        return False
+    with app.app_context():
+        product_ids = write_check['product_ids']
+        stock = db.session.query(db.func.coalesce(db.func.sum(Product.quantity), 0)) \
+            .filter(Product.id.in_(product_ids)).scalar()
+        sold = db.session.query(db.func.coalesce(db.func.sum(Sale.quantity), 0)) \
+            .filter(Sale.id > write_check['last_sale_id'], Sale.product_id.in_(product_ids)).scalar()
+        negative = Product.query.filter(Product.id.in_(product_ids), Product.quantity < 0).count()
+    decrement = write_check['stock'] - stock
+    ok = decrement == sold and not negative
+    print(f'stock check: {sold} units sold, stock fell by {decrement}'
+          + ('' if ok else f' - MISMATCH ({negative} products below zero)'))
+    return not ok
+
+if __name__ == '__main__':
+    scenarios = build_scenarios()
+    results = run_concurrent(scenarios) if args.concurrency else run_sequential(scenarios)
+    mode = 'concurrent' if args.concurrency else 'sequential'
+    baselines = {}
+    if os.path.exists(baseline_path):
+        with open(baseline_path) as f:
+            baselines = json.load(f)
+    regressions = report(results, baselines.get(mode, {}))
+    failed = bool(regressions)
+    if args.writes:
+        failed = check_stock() or failed
+    if args.save_baseline:
+        baselines[mode] = results
+        os.makedirs(os.path.dirname(baseline_path) or '.', exist_ok=True)
+        with open(baseline_path, 'w') as f:
+            json.dump(baselines, f, indent=2, sort_keys=True)
+        print(f'Baseline saved to {baseline_path}')
+    elif regressions:
+        print(f'Regressions against baseline: {", ".join(sorted(set(regressions)))}')
+    sys.exit(1 if failed and not args.save_baseline else 0)
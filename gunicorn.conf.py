@@ -0,0 +1,37 @@
+import multiprocessing
+import os
+
+# Production serving mode, read automatically by `gunicorn app:app` from this directory. Threaded workers
+# keep the tills responsive while a report runs: report DB work is capped per process by REPORT_WORKERS /
+# REPORT_QUEUE in app.py, so the remaining threads stay free for /record_sale and /api/sales.
+bind = os.environ.get('BIND', f"0.0.0.0:{os.environ.get('PORT', 5000)}")
+workers = int(os.environ.get('WEB_CONCURRENCY', multiprocessing.cpu_count() + 1))
+worker_class = 'gthread'
+threads = int(os.environ.get('GUNICORN_THREADS', 8))
+
+# Import the app (and run its startup tasks) once in the master instead of once per worker
+preload_app = True
+
+# Recycle workers now and then to cap memory growth from large reports; the jitter avoids restarting them all at once
+max_requests = int(os.environ.get('GUNICORN_MAX_REQUESTS', 1000))
+max_requests_jitter = int(os.environ.get('GUNICORN_MAX_REQUESTS_JITTER', 100))
+
+# Full-ledger PDFs can take a while; the timeout only applies to a worker that stops responding altogether
+timeout = int(os.environ.get('GUNICORN_TIMEOUT', 120))
+graceful_timeout = 30
+keepalive = 5
+
+# With preload_app the app module is imported in the master, and a job thread started there would not survive
+# the fork, so background jobs are started in each worker instead (claim_job keeps them from running twice).
+# Writes keep the stock alerts current; the job's rescan picks up what changes with the date alone
+background_jobs = os.environ.get('BACKGROUND_JOBS', '1') == '1'
+os.environ['BACKGROUND_JOBS'] = '0'
+
+def post_fork(server, worker):
+    from app import app, db, start_background_jobs
+    # Connections the master opened while preloading must not be shared with the workers
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    if background_jobs:
+        start_background_jobs()
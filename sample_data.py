@@ -1,10 +1,105 @@
-from app import db, Product, Supplier, Customer, Expense, app
+import argparse
+import random
+from itertools import islice
+from app import db, Product, Supplier, Customer, Sale, Expense, app, reset_database, rebuild_daily_summary, \
+    rebuild_customer_stats, run_due_jobs, open_stock_ledger
 from datetime import datetime, timedelta
 
+# With no options this loads the small hand-written data set. The options add synthetic rows on top of it,
+# e.g. for benchmarking: python sample_data.py --products 10000 --customers 500000 --sales 10000000 --years 3
+parser = argparse.ArgumentParser(description='Reset the database and load sample data.')
+parser.add_argument('--suppliers', type=int, default=0, help='synthetic suppliers to add')
+parser.add_argument('--products', type=int, default=0, help='synthetic products to add')
+parser.add_argument('--customers', type=int, default=0, help='synthetic customers to add')
+parser.add_argument('--sales', type=int, default=0, help='synthetic sales to add')
+parser.add_argument('--expenses', type=int, default=0, help='synthetic expenses to add')
+parser.add_argument('--years', type=float, default=1, help='synthetic sales and expenses span this many years up to now')
+parser.add_argument('--seed', type=int, default=42, help='random seed, so runs are reproducible')
+parser.add_argument('--batch-size', type=int, default=10000, help='rows per INSERT batch')
+args = parser.parse_args()
+
+CATEGORIES = ['skincare', 'makeup', 'hair', 'baby']
+PRODUCT_WORDS = ['Hydrating', 'Matte', 'Gentle', 'Volumizing', 'Daily', 'Intense', 'Organic', 'Repair', 'Glow', 'Soothing']
+PRODUCT_TYPES = ['Lotion', 'Cream', 'Serum', 'Shampoo', 'Lipstick', 'Foundation', 'Wipes', 'Oil', 'Gel', 'Balm']
+BRANDS = ['Nivea', "L'Oréal", 'CeraVe', 'Olay', 'Maybelline', 'NYX', 'Pantene', "Johnson's", 'Essence', 'Garnier']
+FIRST_NAMES = ['Grace', 'Faith', 'Joyce', 'Mary', 'Sarah', 'Esther', 'Mercy', 'Ann', 'Lucy', 'Janet', 'Brian', 'Kevin']
+LAST_NAMES = ['Atieno', 'Wanjiku', 'Akinyi', 'Otieno', 'Kemunto', 'Mwangi', 'Njeri', 'Chebet', 'Wambui', 'Kiprono']
+SKIN_TYPES = ['dry', 'oily', 'combination', 'sensitive', 'normal']
+HAIR_TYPES = ['dry', 'oily', 'normal', 'curly']
+DELIVERY_TIMES = ['1-2 days', '2-3 days', '3-5 days', '1 week', '2 weeks']
+PAYMENT_METHODS = ['cash', 'mpesa', 'card']
+EXPENSE_CATEGORIES = ['rent', 'transport', 'utilities', 'stock_purchase', 'other']
+
+def bulk_insert(model, rows):
+    # Plain executemany INSERTs in fixed-size batches; returns the number of rows written
+    rows = iter(rows)
+    total = 0
+    while True:
+        batch = list(islice(rows, args.batch_size))
+        if not batch:
+            return total
+        db.session.execute(db.insert(model.__table__), batch)
+        db.session.commit()
+        total += len(batch)
+        if total // 1000000 > (total - len(batch)) // 1000000:
+            print(f'  {model.__tablename__}: {total:,} rows')
+
+def synthetic_suppliers(count):
+    for i in range(count):
+        yield {'name': f'Supplier {i + 1}', 'contact': f'{random.choice(FIRST_NAMES)} {random.choice(LAST_NAMES)}',
+               'email': f'orders{i + 1}@supplier.co.ke', 'delivery_time': random.choice(DELIVERY_TIMES),
+               'credit_terms': random.choice(['Net 15', 'Net 30', 'Cash on Delivery'])}
+
+def synthetic_products(count, supplier_ids):
+    today = datetime.now().date()
+    for i in range(count):
+        buying_price = random.randint(50, 3000)
+        yield {'name': f'{random.choice(PRODUCT_WORDS)} {random.choice(PRODUCT_TYPES)} {i + 1}',
+               'brand': random.choice(BRANDS), 'category': random.choice(CATEGORIES),
+               'buying_price': buying_price, 'selling_price': round(buying_price * random.uniform(1.2, 1.8)),
+               'quantity': random.randint(0, 200), 'reorder_level': random.randint(5, 30),
+               'supplier_id': random.choice(supplier_ids),
+               'expiry_date': today + timedelta(days=random.randint(-30, 720)) if random.random() < 0.5 else None}
+
+def synthetic_customers(count):
+    for i in range(count):
+        first, last = random.choice(FIRST_NAMES), random.choice(LAST_NAMES)
+        yield {'name': f'{first} {last}', 'phone': f'07{random.randint(0, 99999999):08d}',
+               'email': f'{first.lower()}.{last.lower()}{i + 1}@example.com',
+               'skin_type': random.choice(SKIN_TYPES), 'hair_type': random.choice(HAIR_TYPES)}
+
+def synthetic_sales(count, years):
+    products = db.session.query(Product.id, Product.selling_price, Product.buying_price).all()
+    # A few products sell far more than the rest, as in a real shop
+    cum_weights = []
+    total = 0
+    for rank in range(len(products)):
+        total += 1 / (rank + 1) ** 0.8
+        cum_weights.append(total)
+    random.shuffle(products)
+    first_customer, last_customer = db.session.query(db.func.min(Customer.id), db.func.max(Customer.id)).one()
+    end = datetime.utcnow()
+    step = timedelta(days=365 * years) / max(count, 1)
+    start = end - step * count
+    for i in range(count):
+        product_id, selling_price, buying_price = random.choices(products, cum_weights=cum_weights)[0]
+        quantity = random.choice((1, 1, 1, 2, 2, 3))
+        yield {'product_id': product_id,
+               'customer_id': random.randint(first_customer, last_customer) if random.random() < 0.6 else None,
+               'quantity': quantity, 'unit_price': selling_price, 'total_amount': selling_price * quantity,
+               'profit': (selling_price - buying_price) * quantity, 'payment_method': random.choice(PAYMENT_METHODS),
+               'receipt_number': f'SYN-{i + 1:09d}', 'sale_date': start + step * (i + random.random())}
+
+def synthetic_expenses(count, years):
+    today = datetime.now().date()
+    for i in range(count):
+        yield {'date': today - timedelta(days=random.randint(0, int(365 * years))),
+               'category': random.choice(EXPENSE_CATEGORIES), 'description': f'Synthetic expense {i + 1}',
+               'amount': random.randint(500, 50000)}
+
 with app.app_context():
     # Clear existing data
-    db.drop_all()
-    db.create_all()
+    reset_database()
     
     # Add Suppliers
     suppliers = [
@@ -87,6 +182,7 @@ with app.app_context():
     ]
     db.session.add_all(products)
     db.session.commit()
+    open_stock_ledger()
     
     # Add Customers
     customers = [
@@ -116,3 +212,22 @@ with app.app_context():
     print(f"- {len(products)} products")
     print(f"- {len(customers)} customers")
     print(f"- {len(expenses)} expenses")
+
+    if any((args.suppliers, args.products, args.customers, args.sales, args.expenses)):
+        random.seed(args.seed)
+        print("Adding synthetic data...")
+        print(f"- {bulk_insert(Supplier, synthetic_suppliers(args.suppliers)):,} suppliers")
+        supplier_ids = [supplier_id for (supplier_id,) in db.session.query(Supplier.id)]
+        print(f"- {bulk_insert(Product, synthetic_products(args.products, supplier_ids)):,} products")
+        open_stock_ledger()
+        print(f"- {bulk_insert(Customer, synthetic_customers(args.customers)):,} customers")
+        print(f"- {bulk_insert(Sale, synthetic_sales(args.sales, args.years)):,} sales")
+        print(f"- {bulk_insert(Expense, synthetic_expenses(args.expenses, args.years)):,} expenses")
+        # Derived tables and planner statistics, as the app would have built them over time
+        rebuild_daily_summary()
+        rebuild_customer_stats()
+        run_due_jobs(force=True)
+        if db.engine.dialect.name == 'sqlite':
+            db.session.execute(db.text('ANALYZE'))
+            db.session.commit()
+        print("Synthetic data added successfully!")
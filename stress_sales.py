@@ -0,0 +1,120 @@
+import argparse
+import multiprocessing
+import os
+import random
+import sys
+import tempfile
+import time
+
+# Sells a few scarce products from many processes at once through /record_sale and /checkout, then checks the
+# ledger: every unit sold came off the stock, no stock went negative and no receipt number was issued twice.
+#   python stress_sales.py --processes 16 --requests 300
+#   DATABASE_URL=sqlite:////tmp/stress.db python stress_sales.py   (any empty or scratch database)
+parser = argparse.ArgumentParser(description='Concurrent sale stress test.')
+parser.add_argument('--processes', type=int, default=8, help='worker processes selling at the same time')
+parser.add_argument('--requests', type=int, default=200, help='sale requests per process')
+parser.add_argument('--products', type=int, default=5, help='products competed for')
+parser.add_argument('--stock', type=int, default=400, help='starting stock per product (keep it below demand)')
+parser.add_argument('--seed', type=int, default=1)
+args = parser.parse_args()
+
+if not os.environ.get('DATABASE_URL'):
+    os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(tempfile.mkdtemp(), "stress.db")}'
+os.environ['BACKGROUND_JOBS'] = '0'
+os.environ['PROFILING'] = '0'
+
+from app import app, db, Product, Sale, StockMovement, open_stock_ledger
+
+def seed():
+    with app.app_context():
+        db.session.execute(db.insert(Product), [
+            {'name': f'Stress Product {i}', 'brand': 'Stress', 'category': 'makeup', 'buying_price': 100,
+             'selling_price': 150, 'quantity': args.stock, 'reorder_level': 0} for i in range(args.products)])
+        db.session.commit()
+        open_stock_ledger()
+        product_ids = [product_id for (product_id,) in db.session.query(Product.id)
+                       .filter(Product.brand == 'Stress').order_by(Product.id.desc()).limit(args.products)]
+        stock = dict(db.session.query(Product.id, Product.quantity).filter(Product.id.in_(product_ids)))
+        last_sale_id = db.session.query(db.func.coalesce(db.func.max(Sale.id), 0)).scalar()
+    return product_ids, stock, last_sale_id
+
+def worker(number, product_ids, barrier, results):
+    # Connections inherited through fork must not be shared with the parent or the other workers
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+    rng = random.Random(args.seed * 1000 + number)
+    client = app.test_client()
+    errors = 0
+    barrier.wait()
+    for _ in range(args.requests):
+        if rng.random() < 0.5:
+            response = client.post('/record_sale', data={
+                'product_id': rng.choice(product_ids), 'quantity': rng.randint(1, 3), 'payment_method': 'cash'})
+        else:
+            lines = rng.sample(product_ids, min(len(product_ids), rng.randint(2, 3)))
+            response = client.post('/checkout', data={
+                'product_id': lines, 'quantity': [rng.randint(1, 3) for _ in lines], 'payment_method': 'mpesa'})
+        errors += response.status_code >= 400
+    results.put(errors)
+
+def check(product_ids, stock, last_sale_id):
+    failures = []
+    with app.app_context():
+        new_sales = Sale.query.filter(Sale.id > last_sale_id)
+        sold = dict(db.session.query(Sale.product_id, db.func.sum(Sale.quantity))
+                    .filter(Sale.id > last_sale_id).group_by(Sale.product_id))
+        moved = dict(db.session.query(StockMovement.product_id, -db.func.sum(StockMovement.quantity))
+                     .filter(StockMovement.kind == 'sale', StockMovement.product_id.in_(product_ids))
+                     .group_by(StockMovement.product_id))
+        for product_id in product_ids:
+            remaining = db.session.get(Product, product_id).quantity
+            if remaining < 0:
+                failures.append(f'product {product_id} oversold: stock {remaining}')
+            if stock[product_id] - remaining != sold.get(product_id, 0):
+                failures.append(f'product {product_id}: stock fell by {stock[product_id] - remaining} '
+                                f'but {sold.get(product_id, 0)} units were sold')
+            if moved.get(product_id, 0) != sold.get(product_id, 0):
+                failures.append(f'product {product_id}: ledger has {moved.get(product_id, 0)} units out '
+                                f'for {sold.get(product_id, 0)} sold')
+        # Basket lines are numbered RCP-.../1, RCP-.../2; a receipt reused by two transactions would show up as
+        # a duplicate line number or as lines of one receipt with different sale times
+        lines = new_sales.with_entities(Sale.receipt_number, Sale.sale_date).all()
+        count = len(lines)
+        distinct = len({receipt_number for receipt_number, _ in lines})
+        if distinct != count:
+            failures.append(f'{count - distinct} duplicate receipt numbers')
+        sale_dates = {}
+        for receipt_number, sale_date in lines:
+            sale_dates.setdefault(receipt_number.split('/')[0], set()).add(sale_date)
+        receipts = len(sale_dates)
+        shared = [receipt for receipt, dates in sale_dates.items() if len(dates) > 1]
+        if shared:
+            failures.append(f'{len(shared)} receipt numbers used by more than one sale, e.g. {shared[0]}')
+        left = sum(db.session.get(Product, product_id).quantity for product_id in product_ids)
+    print(f'{count} sale lines under {receipts} receipts, {sum(sold.values())} units sold, {left} left in stock')
+    return failures
+
+if __name__ == '__main__':
+    product_ids, stock, last_sale_id = seed()
+    context = multiprocessing.get_context('fork')
+    barrier = context.Barrier(args.processes)
+    results = context.Queue()
+    processes = [context.Process(target=worker, args=(i, product_ids, barrier, results))
+                 for i in range(args.processes)]
+    started = time.perf_counter()
+    for process in processes:
+        process.start()
+    errors = sum(results.get() for _ in processes)
+    for process in processes:
+        process.join()
+    elapsed = time.perf_counter() - started
+    print(f'{args.processes * args.requests} requests from {args.processes} processes in {elapsed:.1f}s '
+          f'({args.processes * args.requests / elapsed:.0f} req/s), {errors} error responses')
+    failures = check(product_ids, stock, last_sale_id)
+    if errors:
+        failures.append(f'{errors} requests failed')
+    for failure in failures:
+        print(f'FAIL: {failure}')
+    print('FAILED' if failures else 'OK: no oversells, no receipt collisions')
+    sys.exit(1 if failures else 0)